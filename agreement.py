@@ -5,15 +5,12 @@ import glob
 import os
 import json
 from collections import Counter
-import datetime
-import itertools
 import re
-from sklearn.metrics import confusion_matrix
-from natsort import natsorted
+import numpy
+from paraanno import iaa
+from paraanno.iaa import label_sort_key, pairwise_confusions, cohen_kappa, krippendorff_alpha
 
 
-sort_order = ['4', '4s', '4i', '4is', '4A', '4<', '4>','4<i', '4>i','4<s', '4>s','4<is', '4>is', '3', '2', '1']
-
 def read_files(args):
     json_files = glob.glob(os.path.join(args.data_dir, "**", "*.json"), recursive=True)
     
@@ -26,24 +23,15 @@ def read_files(args):
         json_files = [f for f in json_files if annotators_regex.search(f) is not None]
         
     # remove single annotated files (not appearing twice in json_list)
-    basenames = [os.path.basename(f) for f in json_files]
-    json_files = [f for f in json_files if basenames.count(os.path.basename(f)) > 1]
+    basenames = Counter(os.path.basename(f) for f in json_files)
+    json_files = [f for f in json_files if basenames[os.path.basename(f)] > 1]
         
     for f in json_files:
         print(f)
     return json_files
     
 def normalize_label(args, label):
-        label = label.lower().strip()
-        label = "".join(label.split())
-        label = "".join(sorted(label))
-        if args.relaxed is False:
-                return label
-        label = label.replace("s", "")
-        label = label.replace("i", "")
-        label = label.replace("<", "A")
-        label = label.replace(">", "A")
-        return label
+        return iaa.normalize_label(label, args.relaxed)
          
         
 def calculate_idx(example):
@@ -58,14 +46,7 @@ def calculate_idx(example):
         return text, idx
         
 def week(timestamp):
-        if timestamp == "unknown":
-                return timestamp
-        date = datetime.datetime.fromisoformat(timestamp)
-        date = date.isocalendar()
-        year = date[0]
-        week = date[1]
-
-        return f"{year} week {week}"
+        return iaa.iso_week(timestamp)
         
 
 def yield_from_json(args, fname):
@@ -87,9 +68,62 @@ def yield_from_json(args, fname):
         
         yield idx, label, timestamp, os.path.basename(fname), user
         
+class Annotations:
+        """Every annotation as integer codes, read once: one record per (annotator, key, item), key is the week or the file.
+        A later label for the same record replaces the earlier one, like the per-key dicts this used to be."""
+
+        def __init__(self):
+                self.annotators = {} # name -> code, the same for keys and items
+                self.keys = {}
+                self.items = {}
+                self.records = {} # (annotator, key, item) codes -> label
+
+        def add(self, user, key, idx, label):
+                codes = tuple(c.setdefault(v, len(c)) for c, v in ((self.annotators, user), (self.keys, key), (self.items, idx)))
+                self.records[codes] = label
+
+        def freeze(self):
+                # label codes follow the sort order, so any slice of a confusion matrix is in print order
+                self.label_names = sorted(set(self.records.values()), key=label_sort_key)
+                codes = {label: i for i, label in enumerate(self.label_names)}
+                records = numpy.array(list(self.records), dtype=numpy.int64).reshape(-1, 3)
+                self.annotator, self.key, self.item = records.T
+                self.label = numpy.array([codes[label] for label in self.records.values()], dtype=numpy.int64)
+
+        def matrix(self, rows, selection=None):
+                """Label matrix (annotators x items) of the selected records, rows are annotator codes and items those the selection has"""
+                annotator, item, label = self.annotator, self.item, self.label
+                if selection is not None:
+                        annotator, item, label = annotator[selection], item[selection], label[selection]
+                items, columns = numpy.unique(item, return_inverse=True)
+                row_of = numpy.full(len(self.annotators), -1)
+                row_of[rows] = numpy.arange(len(rows))
+                keep = row_of[annotator] >= 0
+                matrix = numpy.full((len(rows), len(items)), -1, dtype=numpy.int64)
+                matrix[row_of[annotator[keep]], columns[keep]] = label[keep]
+                return matrix
+
+        def by_key(self):
+                """key name -> record indices under it"""
+                order = numpy.argsort(self.key, kind="stable")
+                bounds = numpy.flatnonzero(numpy.diff(self.key[order])) + 1
+                names = {code: name for name, code in self.keys.items()}
+                return {names[int(self.key[part[0]])]: part for part in numpy.split(order, bounds) if len(part)}
+
+        def overall(self):
+                """Record indices with one label per annotator and item: the one from the (annotator, key) group seen last, as merging the per-key dicts in order did"""
+                group = self.annotator * len(self.keys) + self.key
+                _, first_seen, inverse = numpy.unique(group, return_index=True, return_inverse=True)
+                rank = first_seen[inverse]
+                cell = self.annotator * len(self.items) + self.item
+                order = numpy.lexsort((rank, cell))
+                last = numpy.append(cell[order][1:] != cell[order][:-1], True)
+                return order[last]
+
+
 def collect_annotations(args, files):
 
-        annotations = {} # key: (annotator, timestamp), value: annotations dictionary where key: idx, value: label
+        annotations = Annotations()
         for fname in files:
                 for idx, label, timestamp, file_name, user in yield_from_json(args, fname):
                 
@@ -97,80 +131,53 @@ def collect_annotations(args, files):
                                 key = timestamp
                         else:
                                 key = file_name
-                        
-                        if (user, key) not in annotations:
-                                annotations[(user, key)] = {}
-                        annotations[(user,key)][idx] = label
+                        annotations.add(user, key, idx, label)
+        annotations.freeze()
         return annotations
         
-def calculate_agreement(annotations_1, annotations_2):
-        # annotations --> key: idx, value: label
-        if annotations_1 is None or annotations_2 is None:
-                return 0, 0, (None, None)
-        common_keys = set(annotations_1.keys()) & set(annotations_2.keys())
-        if not common_keys:
-                return 0, 0, (None, [])
-        agree = 0
-        labels_1 = []
-        labels_2 = []
-        for key in common_keys:
-                labels_1.append(annotations_1[key])
-                labels_2.append(annotations_2[key])
-                if annotations_1[key] == annotations_2[key]:
-                        agree += 1
-        all_labels = list(set(labels_1+labels_2))
-        all_labels.sort(key = lambda i: sort_order.index(i))
-        conf = confusion_matrix(labels_1, labels_2, labels=all_labels)
-        return agree, len(common_keys), (conf, all_labels)
-        
-def print_agreement(args, agree, total, ann1, ann2, conf):
+def print_agreement(args, confusion, label_names, ann1, ann2):
+        total = int(confusion.sum())
         if total == 0:
                 print(f"No annotations for pair {ann1} – {ann2}.")
                 return
-        print(f"{ann1} – {ann2}: {agree/total*100:.2f}% (N={total})")
+        agree = int(numpy.trace(confusion))
+        kappa = f", kappa={cohen_kappa(confusion):.3f}" if args.show_kappa else ""
+        print(f"{ann1} – {ann2}: {agree/total*100:.2f}% (N={total}){kappa}")
         if args.show_conf:
-                conf, all_labels = conf
-                print(all_labels) 
-                print(conf)                  
+                present = (confusion.sum(axis=0) + confusion.sum(axis=1)) > 0
+                print([l for l, p in zip(label_names, present) if p])
+                print(confusion[present][:, present])
                         
+def print_section(args, annotations, rows, names, selection):
+        matrix = annotations.matrix(rows, selection)
+        confusions = pairwise_confusions(matrix, len(annotations.label_names))
+        for i in range(len(names)):
+                for j in range(i+1, len(names)):
+                        print_agreement(args, confusions[i, j], annotations.label_names, names[i], names[j])
+        if args.show_kappa:
+                print(f"Krippendorff's alpha: {krippendorff_alpha(matrix, len(annotations.label_names)):.3f}")
         
 def agreement(args, annotations):
 
         ann = set(args.annotators.split(",")) if args.annotators is not None else None
 
-        annotators = set([ann for ann, time in annotations.keys()])
+        annotators = set(annotations.annotators)
         if ann is not None:
                 annotators = annotators & ann
-        annotators = list(annotators)
+        annotators = sorted(annotators)
         
         print("Annotators:", annotators)
-        pairs = [(annotators[i], annotators[j]) for i in range(len(annotators)) for j in range(i+1,len(annotators))]
-
-        weeks = sorted(set([w for a, w in annotations.keys()]))
+        rows = numpy.array([annotations.annotators[a] for a in annotators], dtype=numpy.int64)
 
         # KEY BASED (WEEK or FILE) #
-        for w in weeks:
+        by_key = annotations.by_key()
+        for w in sorted(by_key):
                 print(f"\n{w}\n")
-                for ann1, ann2 in pairs:
-                        examples_1 = annotations.get((ann1, w), None)
-                        examples_2 = annotations.get((ann2, w), None)
-                        agree, total, conf = calculate_agreement(examples_1, examples_2)
-                        print_agreement(args, agree, total, ann1, ann2, conf)
+                print_section(args, annotations, rows, annotators, by_key[w])
                         
         # TOTAL #
         print("\nTotal agreement:\n")
-        for ann1, ann2 in pairs:
-                examples_1 = [annotations[(a, w)] for a, w in annotations.keys() if a == ann1]
-                examples_1 = {k: v for d in examples_1 for k, v in d.items()}
-                
-                examples_2 = [annotations[(a, w)] for a, w in annotations.keys() if a == ann2]
-                examples_2 = {k: v for d in examples_2 for k, v in d.items()}
-                
-                agree, total, conf = calculate_agreement(examples_1, examples_2)
-                print_agreement(args, agree, total, ann1, ann2, conf)
-
-        
-        
+        print_section(args, annotations, rows, annotators, annotations.overall())
 
 
 def main(args):
@@ -193,6 +200,7 @@ if __name__=="__main__":
     argparser.add_argument('--weekly', action="store_true", default=False, help='Print weekly statistics (not file based).')
     argparser.add_argument('--relaxed', action="store_true", default=False, help='Relaxed label comparison (4 / 4 arrow / 3 / 2 / 1)')
     argparser.add_argument('--show_conf', action="store_true", default=False, help='Show confusion matrix')
+    argparser.add_argument('--show_kappa', action="store_true", default=False, help="Show Cohen's kappa per pair and Krippendorff's alpha over all annotators")
 
     args = argparser.parse_args()
 
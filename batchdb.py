@@ -0,0 +1,83 @@
+import sys
+import argparse
+import glob
+import os
+import json
+from paraanno.sqlitestore import SqliteStore
+from paraanno.journal import Journal, apply_record
+
+
+def read_files(data_dir):
+    json_files = glob.glob(os.path.join(data_dir, "batches-*", "*.json"))
+    return sorted(json_files)
+
+def read_batch(fname):
+    # like the app: the batch file plus whatever its journal has not compacted yet
+    with open(fname, "rt", encoding="utf-8") as f:
+        data = json.load(f)
+    for rec in Journal(fname).replay():
+        apply_record(data, rec)
+    dirname, basename = fname.split("/")[-2:]
+    return dirname.replace("batches-", ""), basename, data
+
+def batch_json(data):
+    # byte for byte what Batch.save() writes
+    return json.dumps(data, ensure_ascii=False, indent=2, sort_keys=True) + "\n"
+
+def import_batches(args, store):
+    imported = 0
+    for fname in read_files(args.data_dir):
+        user, basename, data = read_batch(fname)
+        if store.import_batch(user, basename, data, replace=args.replace):
+            imported += 1
+        else:
+            print("Skipping already imported", fname, file=sys.stderr)
+    print(f"Imported {imported} batches.", file=sys.stderr)
+
+def export_batches(args, store):
+    exported = 0
+    for user in store:
+        os.makedirs(os.path.join(args.data_dir, f"batches-{user}"), exist_ok=True)
+        for basename in store[user]:
+            fname = os.path.join(args.data_dir, f"batches-{user}", basename)
+            with open(fname, "wt", encoding="utf-8") as f:
+                f.write(batch_json(store.export_batch(user, basename)))
+            exported += 1
+    print(f"Exported {exported} batches.", file=sys.stderr)
+
+def verify_batches(args, store):
+    # the database must give back exactly what the files hold
+    differ = 0
+    for fname in read_files(args.data_dir):
+        user, basename, data = read_batch(fname)
+        if batch_json(store.export_batch(user, basename)) != batch_json(data):
+            print("Differs:", fname, file=sys.stderr)
+            differ += 1
+    print(f"{differ} batches differ.", file=sys.stderr)
+    return differ
+
+
+def main(args):
+
+    store = SqliteStore(args.db or os.path.join(args.data_dir, "paraanno.sqlite"))
+    if args.command == "import":
+        import_batches(args, store)
+    elif args.command == "export":
+        export_batches(args, store)
+    else:
+        sys.exit(1 if verify_batches(args, store) else 0)
+
+
+if __name__=="__main__":
+
+    argparser = argparse.ArgumentParser(description='Move batches between the json files and the sqlite storage of the app (PARAANN_STORAGE=sqlite).')
+    argparser.add_argument('command', choices=["import", "export", "verify"], help='import: json files -> db, export: db -> json files, verify: compare the two')
+    argparser.add_argument('--data-dir', '-d', required=True, help='Top level directory of annotation batches (i.e. /path/to/data if data/batches-Annotator1/batch1.json)')
+    argparser.add_argument('--db', help='Database file (default: DATA_DIR/paraanno.sqlite, same as the app)')
+    argparser.add_argument('--replace', action="store_true", default=False, help='import: overwrite batches already in the database')
+    args = argparser.parse_args()
+
+    main(args)
+
+    # Usage: python batchdb.py import -d /home/ginter/ann_data ; python batchdb.py verify -d /home/ginter/ann_data
+    # Stop the app before exporting into the data dir it serves.
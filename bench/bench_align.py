@@ -0,0 +1,145 @@
+import sys
+import argparse
+import os
+import json
+import time
+import hashlib
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # the repo root, for paraanno
+import reference
+from paraanno.align import normalize_context, matches, suffix_matches, build_spans, context_spans
+
+# Context view alignment benchmarks over the fixed document pairs in pairs.json (a news title up to a subtitle segment).
+# Every stage is timed (best of --repeat) and its peak memory traced, and compared against baseline.json.
+# Span output must be byte-identical to reference.py, the original implementation.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MINLEN = 15 # what the app uses
+
+
+def stages(text1, text2):
+    """name -> function of the benchmarked stages for one document pair, each gets the raw texts"""
+    n1, n2 = normalize_context(text1), normalize_context(text2)
+    blocks = matches(n1, n2, MINLEN)
+    return {"normalize": lambda: (normalize_context(text1), normalize_context(text2)),
+            "matches": lambda: matches(n1, n2, MINLEN),
+            "suffix_matches": lambda: suffix_matches(n1, n2, MINLEN),
+            "build_spans": lambda: (build_spans(n1, [(b[0], b[2]) for b in blocks]), build_spans(n2, [(b[1], b[2]) for b in blocks])),
+            "context_spans": lambda: context_spans(n1, n2, MINLEN)}
+
+def measure(func, repeat, budget):
+    """(best seconds, peak bytes) of func(), repeated up to repeat times or until budget seconds are used"""
+    times = []
+    started = time.perf_counter()
+    while len(times) < repeat and (not times or time.perf_counter() - started < budget):
+        t = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t)
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(times), peak
+
+def spans_json(value):
+    return json.dumps(value, ensure_ascii=False)
+
+def check_identity(text1, text2):
+    """[what differs from reference.py] for one document pair, empty if nothing"""
+    problems = []
+    r1, r2 = reference.normalize_context(text1), reference.normalize_context(text2)
+    n1, n2 = normalize_context(text1), normalize_context(text2)
+    if (n1, n2) != (r1, r2):
+        problems.append("normalize")
+    ref_blocks = reference.matches(r1, r2, MINLEN)
+    if matches(n1, n2, MINLEN) != ref_blocks:
+        problems.append("matches")
+    for engine, blocks in (("difflib", ref_blocks), ("suffix", suffix_matches(r1, r2, MINLEN))):
+        for side, text in ((0, r1), (1, r2)):
+            side_blocks = [(b[side], b[2]) for b in blocks]
+            if spans_json(build_spans(text, side_blocks)) != spans_json(reference.build_spans(text, side_blocks)):
+                problems.append(f"build_spans ({engine} blocks, text{side+1})")
+    expected = reference.build_spans(r1, [(b[0], b[2]) for b in ref_blocks]) + reference.build_spans(r2, [(b[1], b[2]) for b in ref_blocks])
+    if spans_json(context_spans(n1, n2, MINLEN)) != spans_json(expected):
+        problems.append("context_spans")
+    return problems, hashlib.sha256(spans_json(expected).encode("utf-8")).hexdigest()
+
+def compare(results, baseline, threshold, min_seconds, min_bytes):
+    """[regression messages] of results against baseline, only stages in both are compared"""
+    regressions = []
+    for pair, pair_stages in results.items():
+        for stage, now in pair_stages.items():
+            before = baseline.get(pair, {}).get(stage)
+            if before is None:
+                continue
+            if now["seconds"] > before["seconds"] * (1 + threshold) and now["seconds"] - before["seconds"] > min_seconds:
+                regressions.append(f"{pair}/{stage}: {1000*now['seconds']:.2f} ms, baseline {1000*before['seconds']:.2f} ms")
+            if now["peak_bytes"] > before["peak_bytes"] * (1 + threshold) and now["peak_bytes"] - before["peak_bytes"] > min_bytes:
+                regressions.append(f"{pair}/{stage}: peak {now['peak_bytes']} bytes, baseline {before['peak_bytes']} bytes")
+    return regressions
+
+
+def main(args):
+
+    with open(os.path.join(HERE, "pairs.json"), "rt", encoding="utf-8") as f:
+        pairs = json.load(f)
+    if args.only:
+        pairs = [p for p in pairs if p["name"] in args.only]
+    results = {}
+    failed = False
+    for p in pairs:
+        text1, text2 = p["document_context1"], p["document_context2"]
+        problems, digest = check_identity(text1, text2)
+        if problems:
+            print(f"{p['name']}: output differs from reference.py in {', '.join(problems)}", file=sys.stderr)
+            failed = True
+        results[p["name"]] = {}
+        for stage, func in stages(text1, text2).items():
+            seconds, peak = measure(func, args.repeat, args.budget)
+            results[p["name"]][stage] = {"seconds": seconds, "peak_bytes": peak}
+            print(f"{p['name']:<12}{len(text1):>7}{len(text2):>7}  {stage:<16}{1000*seconds:>10.3f} ms{peak/1024:>10.1f} KiB")
+        results[p["name"]]["reference_sha256"] = digest
+
+    if args.json:
+        with open(args.json, "wt") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.update:
+        with open(args.baseline, "wt") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print("Wrote baseline", args.baseline, file=sys.stderr)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, "rt") as f:
+            baseline = json.load(f)
+        timed = {pair: {stage: v for stage, v in st.items() if isinstance(v, dict)} for pair, st in results.items()}
+        regressions = compare(timed, baseline, args.threshold, args.min_ms / 1000, args.min_kib * 1024)
+        for pair, st in results.items():
+            if baseline.get(pair, {}).get("reference_sha256", st["reference_sha256"]) != st["reference_sha256"]:
+                regressions.append(f"{pair}: reference spans differ from the baseline's, pairs.json or reference.py changed")
+        for r in regressions:
+            print("Regression:", r, file=sys.stderr)
+        failed = failed or bool(regressions)
+        print(f"{len(regressions)} regressions against {args.baseline} (threshold {args.threshold:.0%}).", file=sys.stderr)
+    else:
+        print("No baseline at", args.baseline, "- run with --update to record one", file=sys.stderr)
+    return failed
+
+
+if __name__=="__main__":
+
+    argparser = argparse.ArgumentParser(description='Benchmark the context view alignment stages and check their output against the reference implementation.')
+    argparser.add_argument('--baseline', default=os.path.join(HERE, "baseline.json"), help='Baseline results (default: bench/baseline.json)')
+    argparser.add_argument('--update', action="store_true", default=False, help='Record the results as the new baseline instead of comparing')
+    argparser.add_argument('--threshold', type=float, default=0.25, help='Fail when a stage is this much slower or bigger than the baseline (default: 0.25)')
+    argparser.add_argument('--min-ms', type=float, default=0.5, help='Ignore slowdowns smaller than this, timer noise (default: 0.5)')
+    argparser.add_argument('--min-kib', type=float, default=64, help='Ignore peak memory growth smaller than this (default: 64)')
+    argparser.add_argument('--repeat', type=int, default=5, help='Best of this many runs per stage (default: 5)')
+    argparser.add_argument('--budget', type=float, default=2, help='Stop repeating a stage after this many seconds (default: 2)')
+    argparser.add_argument('--only', nargs="+", help='Only these pairs (title, paragraph, article, segment)')
+    argparser.add_argument('--json', help='Also write the results here')
+    args = argparser.parse_args()
+
+    sys.exit(1 if main(args) else 0)
+
+    # Usage: python bench/bench_align.py ; python bench/bench_align.py --update after an intended change
+    # Timings depend on the machine, record the baseline on the one you compare on.
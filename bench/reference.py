@@ -0,0 +1,63 @@
+import difflib
+import html
+import re
+
+# The context view code as it was before any optimization (app.py at the first commit), the benchmarks check the current code against it.
+# Do not change this file: its output is the definition of correct.
+
+
+def normalize_context(text):
+    text=re.sub(r"\n+","\n",text)
+    text=text.replace("<i>"," ").replace("</i>"," ")
+    text=re.sub(r" +"," ",text)
+    return text
+
+
+def matches(s1,s2,minlen=5):
+    m=difflib.SequenceMatcher(None,s1,s2,autojunk=False)
+
+    #returns list of (idx1,idx2,len) perfect matches
+    return sorted(matches_r(m,s1,s2,minlen,0,len(s1),0,len(s2)), key=lambda match: (match[2], match[0]))
+
+def matches_r(m,s1,s2,min_len,s1_beg,s1_end,s2_beg,s2_end):
+    lm=m.find_longest_match(s1_beg,s1_end,s2_beg,s2_end)
+    if lm.size<min_len:
+        return []
+    else:
+        s1_left=s1_beg,lm.a
+        s1_right=lm.a+lm.size,s1_end
+        s1_all=(s1_beg,s1_end)
+        
+        s2_left=s2_beg,lm.b
+        s2_right=lm.b+lm.size,s2_end
+        s2_all=(s2_beg,s2_end)
+        
+        matches=[(lm.a,lm.b,lm.size)]
+        for i1,i2 in ((s1_left,s2_left),(s1_left,s2_right),(s1_right,s2_left),(s1_right,s2_right)):
+            #try all combinations of what remains
+            if i1[1]-i1[0]<min_len:
+                continue #too short to produce match
+            if i2[1]-i2[0]<min_len:
+                continue #too short to produce match
+            sub=matches_r(m,s1,s2,min_len,*i1,*i2)
+            matches.extend(sub)
+        return matches
+
+def build_spans(s,blocks):
+    """s:string, blocks are pairs of (idx,len) of perfect matches"""
+    if not blocks:
+        return [], 0, 0
+    #allright, this is pretty dumb alg!
+    matched_indices=[0]*len(s)
+    for i,l in blocks:
+        for idx in range(i,i+l):
+            matched_indices[idx]=max(matched_indices[idx],l)
+    spandata=[]
+    for c,matched_len in zip(s,matched_indices):
+        #matched_len=(matched_len//5)*5
+        if not spandata or spandata[-1][1]!=matched_len: #first or span with opposite match polarity -> must make new!
+            spandata.append(([],matched_len))
+        spandata[-1][0].append(c)
+    merged_spans=[(html.escape("".join(chars)),matched_len) for chars,matched_len in spandata]
+    return merged_spans, min(matched_indices),max(matched_indices) #min is actually always 0, but it's here for future need
+
@@ -0,0 +1,49 @@
+import sys
+import argparse
+import os
+import urllib.request
+from paraanno.assets import VENDOR_DIR, ASSETS, check_integrity
+
+
+def fetch(path, url, integrity, force=False):
+    fname = os.path.join(VENDOR_DIR, path)
+    if os.path.exists(fname) and not force:
+        return False
+    with urllib.request.urlopen(url, timeout=60) as r:
+        data = r.read()
+    if integrity and not check_integrity(data, integrity):
+        raise ValueError(f"{url} does not match its integrity hash {integrity}")
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    tmp = fname + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, fname)
+    return True
+
+
+def main(args):
+
+    fetched = 0
+    failed = 0
+    for path, (url, integrity) in sorted(ASSETS.items()):
+        try:
+            if fetch(path, url, integrity, force=args.force):
+                print("Fetched", path, file=sys.stderr)
+                fetched += 1
+        except Exception as e:
+            print("Failed", path, e, file=sys.stderr)
+            failed += 1
+    print(f"Fetched {fetched} files into {VENDOR_DIR}, {failed} failed.", file=sys.stderr)
+    return failed
+
+
+if __name__=="__main__":
+
+    argparser = argparse.ArgumentParser(description='Download the pinned front-end libraries into paraanno/static/vendor so the app serves them itself instead of the pages loading them from CDNs.')
+    argparser.add_argument('--force', action="store_true", default=False, help='Download again even if the file is there')
+    args = argparser.parse_args()
+
+    sys.exit(1 if main(args) else 0)
+
+    # Run once on a machine with internet access and commit (or copy over) paraanno/static/vendor.
+    # Until a file is there the pages keep loading it from the CDN.
@@ -0,0 +1,177 @@
+import sys
+import argparse
+import glob
+import os
+import json
+import random
+import threading
+import time
+import urllib.request
+import urllib.error
+from urllib.parse import quote
+
+
+class Recorder:
+    """Latencies and errors per request kind, shared by all sessions"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {} # kind -> [seconds]
+        self.errors = {} # kind -> count
+        self.conflicts = 0
+
+    def record(self, kind, seconds, ok):
+        with self.lock:
+            self.latencies.setdefault(kind, []).append(seconds)
+            if not ok:
+                self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def report(self, elapsed):
+        def percentile(values, p):
+            return values[min(len(values) - 1, int(p / 100 * len(values)))]
+        kinds = {}
+        for kind, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            kinds[kind] = {"requests": len(values),
+                           "errors": self.errors.get(kind, 0),
+                           "rps": len(values) / elapsed,
+                           "p50_ms": 1000 * percentile(values, 50),
+                           "p90_ms": 1000 * percentile(values, 90),
+                           "p99_ms": 1000 * percentile(values, 99),
+                           "max_ms": 1000 * values[-1]}
+        total = sum(k["requests"] for k in kinds.values())
+        return {"seconds": elapsed, "requests": total, "rps": total / elapsed, "save_conflicts": self.conflicts, "kinds": kinds}
+
+
+class Session(threading.Thread):
+    """One annotator: goes through a batch pair by pair, autosaves while typing a label, edits and saves, looks at the context now and then and reloads the batch list."""
+
+    def __init__(self, args, user, batches, recorder, seed, stop_at):
+        super().__init__(daemon=True)
+        self.args = args
+        self.user = user
+        self.batches = batches # [(batchfile, number of pairs)]
+        self.recorder = recorder
+        self.rnd = random.Random(seed)
+        self.stop_at = stop_at
+        self.last_poll = 0
+
+    def request(self, kind, path, method="GET", body=None):
+        url = self.args.url.rstrip("/") + path
+        data = json.dumps(body).encode("utf-8") if body is not None else None
+        req = urllib.request.Request(url, data=data, method=method, headers={"Content-Type": "application/json"} if data else {})
+        started = time.perf_counter()
+        status, payload = None, b""
+        try:
+            with urllib.request.urlopen(req, timeout=self.args.timeout) as r:
+                status, payload = r.status, r.read()
+        except urllib.error.HTTPError as e:
+            status, payload = e.code, e.read()
+        except OSError:
+            pass
+        ok = status is not None and (status < 400 or status == 409)
+        self.recorder.record(kind, time.perf_counter() - started, ok)
+        return status, payload
+
+    def think(self, mean):
+        if mean > 0:
+            time.sleep(self.rnd.expovariate(1000 / mean))
+
+    def save(self, path, version, fields):
+        status, payload = self.request("save", "/saveann/" + path, "PATCH", {"version": version, "fields": fields})
+        if status == 200:
+            return json.loads(payload)["version"]
+        if status == 409: # someone else, take their version and go on
+            with self.recorder.lock:
+                self.recorder.conflicts += 1
+            return json.loads(payload)["version"]
+        return version
+
+    def annotate(self, batchfile, pairseq):
+        path = f"{quote(self.user)}/{quote(batchfile)}/{pairseq}"
+        self.request("pair", "/ann/" + path)
+        status, payload = self.request("pair_api", "/api/ann/" + path)
+        version = json.loads(payload)["pairs"][0]["annotation"].get("version", 0) if status == 200 else 0
+        if self.rnd.random() < self.args.context_rate:
+            self.request("context", "/ann/" + path + "/context")
+            self.think(self.args.think_ms * 3)
+        label = self.rnd.choice(["4", "4", "3", "2", "1", "x"])
+        for i in range(1, len(label) + 1 + self.rnd.randint(0, 2)): # label autosaves on every keystroke, typos included
+            self.think(self.args.think_ms / 5)
+            version = self.save(path, version, {"label": label[:i]})
+        for _ in range(self.rnd.randint(0, self.args.edit_saves)):
+            self.think(self.args.think_ms)
+            version = self.save(path, version, {"rew1": f"rewrite {self.rnd.random()}", "user": self.user})
+
+    def run(self):
+        batchfile, length = self.rnd.choice(self.batches)
+        pairseq = self.rnd.randrange(length)
+        while time.time() < self.stop_at:
+            if time.time() - self.last_poll > self.args.poll_seconds:
+                self.request("index", "/")
+                self.request("batch_list", "/ann/" + quote(self.user))
+                self.request("pair_list", f"/ann/{quote(self.user)}/{quote(batchfile)}")
+                self.last_poll = time.time()
+            self.annotate(batchfile, pairseq)
+            pairseq += 1
+            if pairseq >= length:
+                batchfile, length = self.rnd.choice(self.batches)
+                pairseq = 0
+            self.think(self.args.think_ms)
+
+
+def read_corpus(data_dir):
+    users = {}
+    for fname in sorted(glob.glob(os.path.join(data_dir, "batches-*", "*.json"))):
+        dirname, basename = fname.split("/")[-2:]
+        with open(fname, "rt", encoding="utf-8") as f:
+            users.setdefault(dirname.replace("batches-", ""), []).append((basename, len(json.load(f))))
+    return users
+
+
+def main(args):
+
+    users = read_corpus(args.data_dir)
+    if not users:
+        print("No batches under", args.data_dir, file=sys.stderr)
+        sys.exit(1)
+    recorder = Recorder()
+    started = time.time()
+    names = sorted(users)
+    sessions = [Session(args, names[i % len(names)], users[names[i % len(names)]], recorder, args.seed + i, started + args.duration) for i in range(args.sessions)]
+    for s in sessions:
+        s.start()
+    for s in sessions:
+        s.join()
+    report = recorder.report(time.time() - started)
+    report["sessions"] = args.sessions
+    print(f"{report['requests']} requests in {report['seconds']:.1f}s, {report['rps']:.1f}/s, {report['save_conflicts']} save conflicts")
+    print(f"{'kind':<12}{'requests':>10}{'errors':>8}{'rps':>8}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    for kind, k in report["kinds"].items():
+        print(f"{kind:<12}{k['requests']:>10}{k['errors']:>8}{k['rps']:>8.1f}{k['p50_ms']:>9.1f}{k['p90_ms']:>9.1f}{k['p99_ms']:>9.1f}{k['max_ms']:>9.1f}")
+    if args.json:
+        with open(args.json, "wt") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__=="__main__":
+
+    argparser = argparse.ArgumentParser(description='Replay annotator sessions against a running app and report throughput and latency percentiles per request kind.')
+    argparser.add_argument('--url', default="http://localhost:6666", help='Where the app is, including PARAANN_APP_ROOT if set (default: http://localhost:6666)')
+    argparser.add_argument('--data-dir', '-d', required=True, help='The PARAANN_DATA of the app, users and batches are read from here (make_corpus.py makes one)')
+    argparser.add_argument('--sessions', type=int, default=10, help='Concurrent annotators (default: 10)')
+    argparser.add_argument('--duration', type=float, default=30, help='Seconds to run (default: 30)')
+    argparser.add_argument('--think-ms', type=float, default=200, help='Mean pause between actions, 0 to go flat out (default: 200)')
+    argparser.add_argument('--context-rate', type=float, default=0.2, help='Fraction of pairs whose context view is opened (default: 0.2)')
+    argparser.add_argument('--edit-saves', type=int, default=3, help='At most this many rewrite saves per pair after the label (default: 3)')
+    argparser.add_argument('--poll-seconds', type=float, default=20, help='How often a session reloads the index and batch list (default: 20)')
+    argparser.add_argument('--timeout', type=float, default=30, help='Request timeout in seconds (default: 30)')
+    argparser.add_argument('--seed', type=int, default=1, help='Random seed (default: 1)')
+    argparser.add_argument('--json', help='Also write the report here, to compare runs')
+    args = argparser.parse_args()
+
+    main(args)
+
+    # The app writes annotations into the data dir, run against a copy:
+    # python make_corpus.py -d /tmp/corpus && PARAANN_DATA=/tmp/corpus ./run_flask.sh
+    # python loadtest.py -d /tmp/corpus --sessions 20 --duration 60 --json before.json
@@ -0,0 +1,156 @@
+import sys
+import argparse
+import os
+import json
+import random
+import datetime
+from paraanno.contextstore import ContextStore
+
+
+LABELS = ["4", "4", "4", "4<", "4>", "3", "3", "2", "1"] # roughly how often they get used
+SYLLABLES = ["ka", "ta", "va", "lo", "mi", "ne", "su", "ko", "hi", "jo", "ri", "pa", "le", "tu", "ma", "sa", "en", "ol", "is", "ut", "ää", "yö", "kk", "tt"]
+
+
+class TextMaker:
+    """Finnish-looking nonsense: a fixed vocabulary, sentences and documents built from it"""
+
+    def __init__(self, rnd, vocab=None, vocab_size=5000):
+        self.rnd = rnd
+        self.vocab = vocab or ["".join(rnd.choice(SYLLABLES) for _ in range(rnd.randint(1, 4))) for _ in range(vocab_size)]
+
+    def sentence(self, min_words=4, max_words=16):
+        words = [self.rnd.choice(self.vocab) for _ in range(self.rnd.randint(min_words, max_words))]
+        return words[0].capitalize() + " " + " ".join(words[1:]) + self.rnd.choice([".", ".", ".", "?", "!"])
+
+    def document(self, length):
+        # subtitle-like, one short line per sentence, now and then an <i>italic</i> one
+        lines = []
+        while sum(len(l) + 1 for l in lines) < length:
+            line = self.sentence()
+            if self.rnd.random() < 0.05:
+                line = "<i>" + line + "</i>"
+            lines.append(line)
+        return "\n".join(lines)
+
+    def rewrite(self, text, change=0.3):
+        # the other side of a paraphrase: most words kept, some replaced, dropped or added
+        words = []
+        for w in text.split(" "):
+            r = self.rnd.random()
+            if r < change / 3:
+                continue
+            elif r < 2 * change / 3:
+                words.append(self.rnd.choice(self.vocab))
+            elif r < change:
+                words.extend([w, self.rnd.choice(self.vocab)])
+            else:
+                words.append(w)
+        return " ".join(words) or text
+
+    def parallel_document(self, doc):
+        # mostly the same lines rewritten, some dropped, some new ones
+        lines = []
+        for line in doc.split("\n"):
+            r = self.rnd.random()
+            if r < 0.1:
+                continue
+            if r < 0.2:
+                lines.append(self.sentence())
+            lines.append(line if r > 0.7 else self.rewrite(line))
+        return "\n".join(lines)
+
+
+def make_pair(maker, rnd, doc1, doc2, seq, name):
+    lines1 = doc1.split("\n")
+    i = rnd.randrange(len(lines1))
+    txt1 = lines1[i].replace("<i>", "").replace("</i>", "")
+    txt2 = maker.rewrite(txt1)
+    return {"id": f"synthetic_{seq}",
+            "txt1": txt1,
+            "txt2": txt2,
+            "document_context1": doc1,
+            "document_context2": doc2,
+            "focus1": f"left-{i}-0", "anchor1": f"left-{i}-0",
+            "focus2": f"right-{i}-0", "anchor2": f"right-{i}-0",
+            "local_context1": "", "local_context2": "",
+            "meta": {"name": name, "source_files": "make_corpus.py"}}
+
+def annotate(pair, rnd, user, args, now):
+    if rnd.random() >= args.annotated:
+        return
+    label = "x" if rnd.random() < args.skipped else rnd.choice(LABELS)
+    if label.startswith("4") and rnd.random() < 0.3: # s and i only go with 4s, see SORT_ORDER in paraanno/iaa.py
+        label += rnd.choice(["s", "i", "si"])
+    flagged = rnd.random() < args.flagged
+    updated = now - datetime.timedelta(seconds=rnd.randrange(args.days * 24 * 3600))
+    pair["annotation"] = {"label": label,
+                          "rew1": pair["txt1"] if label.startswith("4") else "",
+                          "rew2": pair["txt2"] if label.startswith("4") else "",
+                          "txt1inp": pair["txt1"],
+                          "txt2inp": pair["txt2"],
+                          "user": user,
+                          "flagged": "true" if flagged else "false",
+                          "flagcomment": "check this one" if flagged else "",
+                          "updated": updated.isoformat(),
+                          "version": 1}
+
+def make_batch(vocab, args, batch_seed):
+    # pairs come in runs that share their document pair, like the pairs picked from one subtitle segment
+    brnd = random.Random(batch_seed)
+    bmaker = TextMaker(brnd, vocab)
+    data = []
+    while len(data) < args.pairs:
+        length = max(200, int(brnd.gauss(args.context_length, args.context_length / 4)))
+        doc1 = bmaker.document(length)
+        doc2 = bmaker.parallel_document(doc1)
+        name = f"Synthetic document {batch_seed}-{len(data)}"
+        for _ in range(min(args.pairs_per_document, args.pairs - len(data))):
+            data.append(make_pair(bmaker, brnd, doc1, doc2, batch_seed * 100000 + len(data), name))
+    return data
+
+
+def main(args):
+
+    rnd = random.Random(args.seed)
+    maker = TextMaker(rnd)
+    store = ContextStore(os.path.join(args.data_dir, "contexts")) if args.context_store else None
+    now = datetime.datetime(2021, 6, 1)
+    total = 0
+    for u in range(args.users):
+        user = f"Annotator{u+1}"
+        dirname = os.path.join(args.data_dir, f"batches-{user}")
+        os.makedirs(dirname, exist_ok=True)
+        for b in range(args.batches):
+            # the first --shared batches have the same pairs for every user, for agreement numbers
+            data = make_batch(maker.vocab, args, args.seed * 1000 + (b if b < args.shared else 1000 * (u + 1) + b))
+            for pair in data:
+                annotate(pair, rnd, user, args, now)
+                if store is not None:
+                    store.externalize(pair)
+            with open(os.path.join(dirname, f"batch{b+1}.json"), "wt", encoding="utf-8") as f:
+                print(json.dumps(data, ensure_ascii=False, indent=2, sort_keys=True), file=f)
+            total += len(data)
+    print(f"Wrote {total} pairs in {args.users * args.batches} batches under {args.data_dir}.", file=sys.stderr)
+
+
+if __name__=="__main__":
+
+    argparser = argparse.ArgumentParser(description='Generate a synthetic PARAANN_DATA tree of any size for performance work (make_dummy.py is six pairs).')
+    argparser.add_argument('--data-dir', '-d', required=True, help='Where to write batches-<user>/batch<n>.json')
+    argparser.add_argument('--users', type=int, default=5, help='Number of annotators (default: 5)')
+    argparser.add_argument('--batches', type=int, default=20, help='Batches per annotator (default: 20)')
+    argparser.add_argument('--pairs', type=int, default=100, help='Pairs per batch (default: 100)')
+    argparser.add_argument('--pairs-per-document', type=int, default=5, help='Consecutive pairs sharing their document contexts (default: 5)')
+    argparser.add_argument('--context-length', type=int, default=3000, help='Mean length of a document context in characters (default: 3000)')
+    argparser.add_argument('--annotated', type=float, default=0.5, help='Fraction of pairs with an annotation (default: 0.5)')
+    argparser.add_argument('--skipped', type=float, default=0.05, help='Fraction of the annotated pairs labeled x (default: 0.05)')
+    argparser.add_argument('--flagged', type=float, default=0.02, help='Fraction of the annotated pairs flagged (default: 0.02)')
+    argparser.add_argument('--shared', type=int, default=2, help='This many batches are the same for all users (default: 2)')
+    argparser.add_argument('--days', type=int, default=60, help='Annotation timestamps spread over this many days (default: 60)')
+    argparser.add_argument('--context-store', action="store_true", default=False, help='Store the contexts in DATA_DIR/contexts like migrate_contexts.py does')
+    argparser.add_argument('--seed', type=int, default=1, help='Random seed, the same arguments and seed give the same corpus (default: 1)')
+    args = argparser.parse_args()
+
+    main(args)
+
+    # Usage: python make_corpus.py -d /tmp/corpus --users 10 --batches 50 --pairs 200
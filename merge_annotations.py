@@ -6,10 +6,25 @@ import os
 import json
 import datetime
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from paraanno.contextstore import ContextStore
+from paraanno.loader import file_stat
+
+MANIFEST = ".merge-manifest.json" # in OUT_DIR: per batch the input file stats, the item fingerprints and the numbers of the last merge
 
 def read_files(args):
     json_files = glob.glob(os.path.join(args.data_dir, "**", args.file_name), recursive=True)
     return json_files
+
+def group_files(args):
+    # one scan of the whole tree, basename -> files of all annotators, earlier output left out
+    out_dir = os.path.realpath(args.out_dir)
+    groups = {}
+    for fname in sorted(glob.glob(os.path.join(args.data_dir, "**", "*.json"), recursive=True)):
+        if os.path.realpath(fname).startswith(out_dir + os.sep):
+            continue
+        groups.setdefault(os.path.basename(fname), []).append(fname)
+    return groups
     
 def normalize_label(label):
         label = label.strip()
@@ -21,6 +36,14 @@ def calculate_idx(text):
         idx = hashlib.sha224(text.encode()).hexdigest()
         return idx
 
+def fingerprint(idx, annotations):
+        # the item id, the first example (the merged one is built on it) and what merge() reads of the others
+        h = hashlib.sha1(str(idx).encode())
+        for i, ann in enumerate(annotations):
+                part = ann if i == 0 else {"txt1": ann.get("txt1"), "txt2": ann.get("txt2"), "annotation": ann["annotation"]}
+                h.update(hashlib.sha1(json.dumps(part, sort_keys=True).encode()).digest())
+        return h.hexdigest()
+
 def yield_from_json(fname):
 
     with open(fname, "rt", encoding="utf-8") as f:
@@ -89,9 +112,11 @@ def resolve_comments(annotations):
         return comm
                         
         
-def merge(aligned_data, min_annotators=3, min_consensus=0.75, resolve_consensus=False):
+def merge(aligned_data, min_annotators=3, min_consensus=0.75, resolve_consensus=False, previous=None, fingerprints=None):
         # min_annotators: do not automatically resolve if less than this annotated
         # min_consensus: automatically resolve if more than 75% agree
+        # previous: idx -> (fingerprint, merged example) of the last merge, items whose fingerprint is unchanged keep their merged example and timestamp
+        # fingerprints: dict to fill with idx -> fingerprint, for the next merge
         
         timestamp = datetime.datetime.now().isoformat()
         
@@ -102,6 +127,10 @@ def merge(aligned_data, min_annotators=3, min_consensus=0.75, resolve_consensus=
         num_annotators = []
         for idx, annotations in aligned_data.items():
                 annotated_labels = [ann["annotation"]["label"] for ann in annotations]
+                if fingerprints is not None or previous:
+                        fp = fingerprint(idx, annotations)
+                        if fingerprints is not None:
+                                fingerprints[str(idx)] = fp
                 text_inp_1, text_inp_2 = resolve_input_edits(annotations)
                 rew1, rew2 = resolve_rewrites(annotations)
                 flag = is_flagged(annotations)
@@ -124,6 +153,10 @@ def merge(aligned_data, min_annotators=3, min_consensus=0.75, resolve_consensus=
                         label = "|".join(annotated_labels)
                 num_annotators.append(len(annotated_labels))
 
+                if previous and previous.get(str(idx), (None,))[0] == fp: # unchanged since the last merge
+                        consensus.append(previous[str(idx)][1])
+                        continue
+
                 # create new json
                 example = annotations[0]
                 example["annotation"]["label"] = label
@@ -140,6 +173,110 @@ def merge(aligned_data, min_annotators=3, min_consensus=0.75, resolve_consensus=
         return consensus, (full_agreement, consensus_agreement, skipped, num_annotators)
 
 
+def print_stats(merged, full_agreement, consensus_agreement, skipped, annotators):
+    # annotators: (sum, count) of the number of annotators per example
+    total = merged-skipped
+    if total == 0:
+        print(f"Skipped (not enough annotations for agreement score): {skipped}", file=sys.stderr)
+        print(f"Total: {total}", file=sys.stderr)
+        return
+        
+    
+    print(f"Full agreement: {full_agreement} ({full_agreement/total*100}%)", file=sys.stderr)
+    print(f"Concensus agreement: {consensus_agreement} ({consensus_agreement/total*100}%)", file=sys.stderr)
+    print(f"Total: {total}", file=sys.stderr)
+    print(f"Average number of annotators: {annotators[0]/annotators[1]}", file=sys.stderr)
+    print(f"Skipped (not enough annotations): {skipped}", file=sys.stderr)
+
+
+def read_output(out):
+    try:
+        with open(out, "rt", encoding="utf-8") as f:
+            return {str(example["id"]): example for example in json.load(f)}
+    except (OSError, ValueError):
+        return None
+
+def write_output(out, merged):
+    tmp = out + ".tmp"
+    with open(tmp, "wt", encoding="utf-8") as f:
+        json.dump(merged, f, sort_keys=True, indent=2, ensure_ascii=False) # written as it is encoded, no second copy as one string
+        f.write("\n")
+    os.replace(tmp, out)
+
+def merge_batch(job):
+    # one basename in a worker process: merge, write OUT_DIR/basename if anything changed, return (basename, files, what happened, items merged anew, manifest entry)
+    basename, files, args, last = job
+    out = os.path.join(args.out_dir, basename)
+    inputs = {fname: file_stat(fname) for fname in files}
+    output_stat = file_stat(out) if os.path.exists(out) else None
+    if last is None or output_stat is None or last["output"] != output_stat: # first merge, or the output was changed or removed by hand
+        last = None
+    elif last["inputs"] == inputs:
+        return basename, len(files), "unchanged", 0, last
+    previous = {}
+    if last is not None:
+        examples = read_output(out) or {}
+        previous = {idx: (fp, examples[idx]) for idx, fp in last["items"].items() if idx in examples}
+    fingerprints = {}
+    merged, (full_agreement, consensus_agreement, skipped, annotators) = merge(align(files), min_annotators=args.min_annotators, resolve_consensus=args.resolve_consensus, previous=previous, fingerprints=fingerprints)
+    remerged = sum(1 for idx, fp in fingerprints.items() if previous.get(idx, (None,))[0] != fp)
+    if not args.keep_context_refs:
+        store = ContextStore(os.path.join(args.data_dir, "contexts"))
+        for example in merged:
+            store.inline(example)
+    if last is not None and remerged == 0 and list(fingerprints) == list(last["items"]): # same items in the same order
+        status = "kept"
+    else:
+        write_output(out, merged)
+        output_stat = file_stat(out)
+        status = "written"
+    entry = {"inputs": inputs, "output": output_stat, "items": fingerprints,
+             "numbers": [len(merged), full_agreement, consensus_agreement, skipped, sum(annotators), len(annotators)]}
+    return basename, len(files), status, remerged, entry
+
+def read_manifest(args):
+    # basename -> entry of the last run, empty if there was none or it was made with other options
+    options = {"min_annotators": args.min_annotators, "resolve_consensus": args.resolve_consensus, "keep_context_refs": args.keep_context_refs}
+    try:
+        with open(os.path.join(args.out_dir, MANIFEST), "rt") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return options, {}
+    if args.full or manifest.get("options") != options:
+        return options, {}
+    return options, manifest["batches"]
+
+def write_manifest(args, options, batches):
+    fname = os.path.join(args.out_dir, MANIFEST)
+    with open(fname + ".tmp", "wt") as f:
+        json.dump({"options": options, "batches": batches}, f)
+    os.replace(fname + ".tmp", fname)
+
+def merge_all(args):
+
+    groups = group_files(args)
+    os.makedirs(args.out_dir, exist_ok=True)
+    options, manifest = read_manifest(args)
+    jobs = [(basename, files, args, manifest.get(basename)) for basename, files in sorted(groups.items())]
+    print(f"Merging {len(jobs)} batches from {sum(len(files) for files in groups.values())} files", file=sys.stderr)
+    if args.workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(args.workers) as pool:
+            results = list(pool.map(merge_batch, jobs))
+    else:
+        results = [merge_batch(job) for job in jobs]
+    write_manifest(args, options, {basename: entry for basename, _, _, _, entry in results})
+    
+    totals = [0] * 6
+    statuses = Counter()
+    for basename, n_files, status, remerged, entry in results:
+        print(f"{basename}: {n_files} files, {entry['numbers'][0]} examples, {remerged} merged anew, {status}", file=sys.stderr)
+        totals = [t + n for t, n in zip(totals, entry["numbers"])]
+        statuses[status] += 1
+    merged, full_agreement, consensus_agreement, skipped, annotators_sum, annotators_count = totals
+    print(f"Wrote {statuses['written']} batches to {args.out_dir}, {statuses['kept']} had no changes in their items, {statuses['unchanged']} no changes in their files", file=sys.stderr)
+    print_stats(merged, full_agreement, consensus_agreement, skipped, (annotators_sum, annotators_count))
+
+
 def main(args):
 
     all_files = read_files(args) # all files from different annotators
@@ -148,23 +285,17 @@ def main(args):
     aligned_examples = align(all_files)
     
     merged, stats = merge(aligned_examples, min_annotators=args.min_annotators, resolve_consensus=args.resolve_consensus)
+    
+    if not args.keep_context_refs:
+        store = ContextStore(os.path.join(args.data_dir, "contexts"))
+        for example in merged:
+            store.inline(example)
 
     print(json.dumps(merged, sort_keys=True, indent=2, ensure_ascii=False))
     
     # print stats
     full_agreement, consensus_agreement, skipped, annotators = stats
-    total = len(merged)-skipped
-    if total == 0:
-        print(print(f"Skipped (not enough annotations for agreement score): {skipped}", file=sys.stderr))
-        print(f"Total: {total}", file=sys.stderr)
-        return
-        
-    
-    print(f"Full agreement: {full_agreement} ({full_agreement/total*100}%)", file=sys.stderr)
-    print(f"Concensus agreement: {consensus_agreement} ({consensus_agreement/total*100}%)", file=sys.stderr)
-    print(f"Total: {total}", file=sys.stderr)
-    print(f"Average number of annotators: {sum(annotators)/len(annotators)}", file=sys.stderr)
-    print(f"Skipped (not enough annotations): {skipped}", file=sys.stderr)
+    print_stats(len(merged), full_agreement, consensus_agreement, skipped, (sum(annotators), len(annotators)))
 
 
 
@@ -173,11 +304,22 @@ if __name__=="__main__":
 
     argparser = argparse.ArgumentParser(description='')
     argparser.add_argument('--data-dir', '-d', required=True, help='Top level directory of annotation batches (i.e. /path/to/data if data/batches-Annotator1/batch1.json)')
-    argparser.add_argument('--file-name', '-f', required=True, help='Batch file name (i.e. batch1.json if data/batches-Annotator1/batch1.json)')
+    argparser.add_argument('--file-name', '-f', help='Batch file name (i.e. batch1.json if data/batches-Annotator1/batch1.json)')
+    argparser.add_argument('--out-dir', '-o', help='Merge every batch instead of one --file-name, each into OUT_DIR/<batch file name>')
+    argparser.add_argument('--full', action="store_true", default=False, help='With --out-dir, merge everything again instead of only the items that changed since the last run')
+    argparser.add_argument('--workers', type=int, default=os.cpu_count(), help='With --out-dir, merge this many batches at a time in separate processes (default: number of CPUs)')
     argparser.add_argument('--min-annotators', type=int, default=2, help='How many annotators must be to resolve conflicts automatically if consensus found.')
     argparser.add_argument('--resolve-consensus', action="store_true", default=False, help='Automatically resolve consensus (default=False)')
+    argparser.add_argument('--keep-context-refs', action="store_true", default=False, help='Keep document_context*_ref references as they are instead of resolving them to the texts in DATA_DIR/contexts, for output that stays next to the store (default=False)')
     args = argparser.parse_args()
+    if (args.file_name is None) == (args.out_dir is None):
+        argparser.error("give either --file-name or --out-dir")
 
-    main(args)
+    if args.out_dir:
+        merge_all(args)
+    else:
+        main(args)
     
     # Usage: python merge_annotations.py -d /home/ginter/ann_data/news_titles_assigned -f sub_ann_train_000200.json > sub_ann_train_000200.json
+    # All batches: python merge_annotations.py -d /home/ginter/ann_data/news_titles_assigned -o merged/
+    # Run it again after edits and only the changed items are merged, the rest keep their output and timestamps (see OUT_DIR/.merge-manifest.json)
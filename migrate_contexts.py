@@ -0,0 +1,56 @@
+import sys
+import argparse
+import glob
+import os
+import json
+from paraanno.contextstore import ContextStore
+
+
+def read_files(args):
+    json_files = glob.glob(os.path.join(args.data_dir, "batches-*", "**", "*.json"), recursive=True)
+    return sorted(json_files)
+
+
+def migrate(fname, store, inline=False):
+
+    with open(fname, "rt", encoding="utf-8") as f:
+        data = json.load(f)
+    changed = 0
+    for example in data:
+        if inline:
+            changed += store.inline(example)
+        else:
+            changed += store.externalize(example)
+    if changed:
+        tmp = fname + ".tmp"
+        with open(tmp, "wt", encoding="utf-8") as f:
+            print(json.dumps(data, ensure_ascii=False, indent=2, sort_keys=True), file=f)
+        os.replace(tmp, fname)
+    return changed
+
+
+def main(args):
+
+    store = ContextStore(args.store or os.path.join(args.data_dir, "contexts"))
+    files = read_files(args)
+    total = 0
+    for fname in files:
+        changed = migrate(fname, store, inline=args.inline)
+        if changed:
+            print(f"{fname}: {changed} examples", file=sys.stderr)
+        total += changed
+    print(f"{'Inlined' if args.inline else 'Externalized'} contexts of {total} examples in {len(files)} files.", file=sys.stderr)
+
+
+if __name__=="__main__":
+
+    argparser = argparse.ArgumentParser(description='Move document_context1/2 of every example into the shared context store (or back with --inline).')
+    argparser.add_argument('--data-dir', '-d', required=True, help='Top level directory of annotation batches (i.e. /path/to/data if data/batches-Annotator1/batch1.json)')
+    argparser.add_argument('--store', help='Context store directory (default: DATA_DIR/contexts, same as the app)')
+    argparser.add_argument('--inline', action="store_true", default=False, help='Resolve references back into the batch files')
+    args = argparser.parse_args()
+
+    main(args)
+
+    # Stop the annotation app first, it would overwrite the batches with what it has in memory.
+    # Usage: python migrate_contexts.py -d /home/ginter/ann_data
@@ -0,0 +1,220 @@
+import difflib
+import html
+import re
+import hashlib
+import threading
+import collections
+import numpy
+import gzip
+import json
+import os
+from sqlitedict import SqliteDict
+
+
+def normalize_context(text):
+    #what the context view shows and aligns
+    text=re.sub(r"\n+","\n",text)
+    text=text.replace("<i>"," ").replace("</i>"," ")
+    text=re.sub(r" +"," ",text)
+    return text
+
+
+def matches(s1,s2,minlen=5):
+    m=difflib.SequenceMatcher(None,s1,s2,autojunk=False)
+
+    #returns list of (idx1,idx2,len) perfect matches
+    return sorted(matches_r(m,s1,s2,minlen,0,len(s1),0,len(s2)), key=lambda match: (match[2], match[0]))
+
+def matches_r(m,s1,s2,min_len,s1_beg,s1_end,s2_beg,s2_end):
+    lm=m.find_longest_match(s1_beg,s1_end,s2_beg,s2_end)
+    if lm.size<min_len:
+        return []
+    else:
+        s1_left=s1_beg,lm.a
+        s1_right=lm.a+lm.size,s1_end
+        s1_all=(s1_beg,s1_end)
+        
+        s2_left=s2_beg,lm.b
+        s2_right=lm.b+lm.size,s2_end
+        s2_all=(s2_beg,s2_end)
+        
+        matches=[(lm.a,lm.b,lm.size)]
+        for i1,i2 in ((s1_left,s2_left),(s1_left,s2_right),(s1_right,s2_left),(s1_right,s2_right)):
+            #try all combinations of what remains
+            if i1[1]-i1[0]<min_len:
+                continue #too short to produce match
+            if i2[1]-i2[0]<min_len:
+                continue #too short to produce match
+            sub=matches_r(m,s1,s2,min_len,*i1,*i2)
+            matches.extend(sub)
+        return matches
+
+def build_spans(s,blocks):
+    """s:string, blocks are pairs of (idx,len) of perfect matches"""
+    if not blocks:
+        return [], 0, 0
+    #every position gets the length of the longest block covering it: fill shortest first so longer blocks overwrite
+    matched_indices=numpy.zeros(len(s),dtype=numpy.int64)
+    for i,l in sorted(blocks,key=lambda block: block[1]):
+        matched_indices[i:i+l]=l
+    #runs of equal matched length become spans
+    bounds=(numpy.flatnonzero(matched_indices[1:]!=matched_indices[:-1])+1).tolist()
+    starts=[0]+bounds
+    ends=bounds+[len(s)]
+    lengths=matched_indices[starts].tolist()
+    merged_spans=[(html.escape(s[b:e]),matched_len) for b,e,matched_len in zip(starts,ends,lengths)]
+    return merged_spans, int(matched_indices.min()), int(matched_indices.max()) #min is actually always 0, but it's here for future need
+
+#matches("Minulla on koira mutta sinulla on kissa.","Sinulla on kissa ja minulla on koira.")
+
+def suffix_automaton(s):
+    """Suffix automaton of s as (next, link, length, endpos), endpos is the end index of the first occurrence of each state"""
+    nxt=[{}]
+    link=[-1]
+    length=[0]
+    endpos=[-1]
+    last=0
+    for i,c in enumerate(s):
+        cur=len(nxt)
+        nxt.append({})
+        link.append(0)
+        length.append(length[last]+1)
+        endpos.append(i)
+        p=last
+        while p!=-1 and c not in nxt[p]:
+            nxt[p][c]=cur
+            p=link[p]
+        if p!=-1:
+            q=nxt[p][c]
+            if length[p]+1==length[q]:
+                link[cur]=q
+            else:
+                clone=len(nxt)
+                nxt.append(dict(nxt[q]))
+                link.append(link[q])
+                length.append(length[p]+1)
+                endpos.append(endpos[q])
+                while p!=-1 and nxt[p].get(c)==q:
+                    nxt[p][c]=clone
+                    p=link[p]
+                link[q]=clone
+                link[cur]=clone
+        last=cur
+    return nxt,link,length,endpos
+
+def maximal_matches(s,t,minlen):
+    """(idx_t,idx_s,len) for every maximal substring of t of length>=minlen that occurs in s, with one occurrence in s each. Linear in len(s)+len(t)."""
+    nxt,link,length,endpos=suffix_automaton(s)
+    result=[]
+    v,l=0,0
+    prev=None #(l,end in s) at the previous position of t
+    for j,c in enumerate(t):
+        while v and c not in nxt[v]:
+            v=link[v]
+            l=length[v]
+        if c in nxt[v]:
+            v=nxt[v][c]
+            l+=1
+        else:
+            v,l=0,0
+        #the match ending at j-1 was maximal unless it grew by one here
+        if prev is not None and prev[0]>=minlen and l!=prev[0]+1:
+            result.append((j-prev[0],prev[1]-prev[0]+1,prev[0]))
+        prev=(l,endpos[v])
+    if prev is not None and prev[0]>=minlen:
+        result.append((len(t)-prev[0],prev[1]-prev[0]+1,prev[0]))
+    return result
+
+def suffix_matches(s1,s2,minlen=5):
+    """Drop-in for matches(): all maximal common substrings of length>=minlen, so every position of either text is covered by the longest common substring it belongs to.
+    Near-linear, unlike the recursive SequenceMatcher search, but does not give the same blocks."""
+    found=set((i1,i2,l) for i1,i2,l in maximal_matches(s2,s1,minlen))
+    found.update((i1,i2,l) for i2,i1,l in maximal_matches(s1,s2,minlen))
+    return sorted(found, key=lambda match: (match[2], match[0]))
+
+ENGINES={"difflib":matches,"suffix":suffix_matches} #PARAANN_ALIGN_ENGINE
+
+
+class AlignmentCache:
+    """Span data of the context view keyed by a hash of the normalized texts and minlen.
+    An in-memory LRU in front of an optional sqlite file, so repeat views are cheap and survive restarts."""
+
+    def __init__(self,fname=None,size=64):
+        self.size=size
+        self.memory=collections.OrderedDict()
+        self.lock=threading.Lock()
+        self.disk=SqliteDict(fname,tablename="spans",autocommit=True) if fname else None
+        self.hits=0
+        self.misses=0
+
+    @staticmethod
+    def key(text1,text2,minlen,engine="difflib"):
+        h=hashlib.sha256()
+        for part in (text1,text2,str(minlen),engine):
+            h.update(part.encode("utf-8"))
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def get(self,key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits+=1
+                return self.memory[key]
+        value=self.disk.get(key) if self.disk is not None else None
+        with self.lock:
+            if value is None:
+                self.misses+=1
+            else:
+                self.hits+=1
+                self._remember(key,value)
+        return value
+
+    def put(self,key,value):
+        with self.lock:
+            self._remember(key,value)
+        if self.disk is not None:
+            self.disk[key]=value
+
+    def _remember(self,key,value):
+        self.memory[key]=value
+        self.memory.move_to_end(key)
+        while len(self.memory)>self.size:
+            self.memory.popitem(last=False)
+
+
+def read_precomputed(fname):
+    """Blocks written by precompute_alignments.py next to a batch: cache key -> [(idx1,idx2,len)]"""
+    if not os.path.exists(fname):
+        return {}
+    with gzip.open(fname,"rt",encoding="utf-8") as f:
+        stored=json.load(f)
+    return {key:[tuple(flat[i:i+3]) for i in range(0,len(flat),3)] for key,flat in stored["blocks"].items()}
+
+def write_precomputed(fname,blocks,minlen,engine):
+    """blocks: cache key -> [(idx1,idx2,len)], stored flattened and gzipped"""
+    stored={"minlen":minlen,"engine":engine,"blocks":{key:[x for block in bl for x in block] for key,bl in blocks.items()}}
+    tmp=fname+".tmp"
+    with gzip.open(tmp,"wt",encoding="utf-8") as f:
+        json.dump(stored,f,separators=(",",":"))
+    os.replace(tmp,fname)
+
+def context_spans(text1,text2,minlen=15,cache=None,engine="difflib",precomputed=None):
+    """(spandata1,min1,max1,spandata2,min2,max2) for two normalized texts, engine is a key of ENGINES.
+    precomputed: function returning blocks from read_precomputed(), called on a cache miss only, the blocks are used instead of aligning when the texts match"""
+    key=AlignmentCache.key(text1,text2,minlen,engine)
+    if cache is not None:
+        value=cache.get(key)
+        if value is not None:
+            return value
+    precomputed=precomputed() if precomputed is not None else None
+    if precomputed and key in precomputed:
+        blocks=precomputed[key]
+    else:
+        blocks=ENGINES[engine](text1,text2,minlen) #matches are (idx1,idx2,len)
+    spandata1,min1,max1=build_spans(text1,list((b[0],b[2]) for b in blocks))
+    spandata2,min2,max2=build_spans(text2,list((b[1],b[2]) for b in blocks))
+    value=(spandata1,min1,max1,spandata2,min2,max2)
+    if cache is not None:
+        cache.put(key,value)
+    return value
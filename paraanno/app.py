@@ -7,93 +7,476 @@ import glob
 from sqlitedict import SqliteDict
 import json
 import datetime
-import difflib
-import html
-import re
+import threading
+import atexit
+import contextlib
+import time
+import sys
+import hashlib
+from collections import Counter
+from werkzeug.http import is_resource_modified
+from .journal import Journal, GroupCommitWriter, apply_record, fsync_dir
+from .resident import ResidentSet
+from .contextstore import ContextStore
+from .loader import file_stat, parse_batches
+from .pairs import EDITABLE_FIELDS, StaleWrite, BatchDetached, pair_status, flag_entry, client_pair, agreement_entry
+from .sqlitestore import SqliteStore
+from .assets import asset_url, vendored
+from . import metrics
+from .iaa import LiveAgreement, agreement_report
+from .align import AlignmentCache, ENGINES, normalize_context, context_spans, read_precomputed
 
 
 app = Flask(__name__)
 app.config["TEMPLATES_AUTO_RELOAD"] = True
 APP_ROOT = os.environ.get('PARAANN_APP_ROOT',"")
 app.config["APPLICATION_ROOT"] = APP_ROOT
+app.config["SEND_FILE_MAX_AGE_DEFAULT"] = 365*24*3600 # static/vendor paths carry the library version, see fetch_assets.py
 
 DATADIR=os.environ["PARAANN_DATA"]
+STORAGE=os.environ.get("PARAANN_STORAGE","json") # json: rewrite the batch file on every save, journal: append to <batchfile>.journal and compact in the background, sqlite: everything in PARAANN_DB
+DB_FILE=os.environ.get("PARAANN_DB",os.path.join(DATADIR,"paraanno.sqlite")) # for sqlite storage, fill it with batchdb.py import
+JOURNAL_COMMIT_MS=int(os.environ.get("PARAANN_JOURNAL_COMMIT_MS","20"))
+JOURNAL_COMPACT_SECONDS=int(os.environ.get("PARAANN_JOURNAL_COMPACT_SECONDS","300"))
+journal_writer=None
+LAZY=os.environ.get("PARAANN_LAZY","0")=="1" # load pair data on first access and keep at most PARAANN_MAX_RESIDENT batches in memory
+MAX_RESIDENT=int(os.environ.get("PARAANN_MAX_RESIDENT","50"))
+MAX_RESIDENT_MB=os.environ.get("PARAANN_MAX_RESIDENT_MB") # optional extra budget, counted in batch file sizes
+INDEX_FILE=os.path.join(DATADIR,".paraanno-index.json") # path -> file stat and batch metadata, lets lazy mode start without parsing
+resident=None
+LOAD_WORKERS=int(os.environ.get("PARAANN_LOAD_WORKERS","1")) # parse batch files at startup in this many processes
+SNAPSHOT_DIR=os.path.join(DATADIR,".paraanno-snapshot") if os.environ.get("PARAANN_SNAPSHOT","0")=="1" else None # a pickle per batch file, unchanged files skip json parsing on the next start
+PAGE_SIZE=int(os.environ.get("PARAANN_PAGE_SIZE","500")) # rows per page in the pair and flag listings
+PREFETCH=int(os.environ.get("PARAANN_PREFETCH","5")) # pairs the annotation page fetches ahead through the pair api, 0 turns client-side switching off
+METRICS=os.environ.get("PARAANN_METRICS","0")=="1" # request latencies and storage counters on /metrics, for Prometheus
+RESCAN_SECONDS=int(os.environ.get("PARAANN_RESCAN_SECONDS","0")) # pick up added, removed and externally changed batch files this often, 0 is off
+contexts=ContextStore(os.environ.get("PARAANN_CONTEXTS",os.path.join(DATADIR,"contexts"))) # shared document contexts, see migrate_contexts.py
+ALIGN_CACHE=os.environ.get("PARAANN_ALIGN_CACHE",os.path.join(DATADIR,"alignment-cache.sqlite")) # context view spans survive restarts here, empty string for memory only
+alignment_cache=AlignmentCache(ALIGN_CACHE or None,int(os.environ.get("PARAANN_ALIGN_CACHE_SIZE","64")))
+ALIGN_ENGINE=os.environ.get("PARAANN_ALIGN_ENGINE","difflib") # difflib: recursive SequenceMatcher, suffix: all maximal common substrings via a suffix automaton
+if ALIGN_ENGINE not in ENGINES:
+    raise ValueError(f"PARAANN_ALIGN_ENGINE must be one of {', '.join(ENGINES)}, not {ALIGN_ENGINE}")
+
+user_stats={} #user -> Counter of completed/skipped/left pairs, total pairs, batches and completed_batches, kept up to date by Batch
+flag_index={} #user -> (batchfile, pair index) -> flag_entry(pair), only flagged pairs, kept up to date by Batch
+stats_lock=threading.Lock()
+live_agreement=LiveAgreement() #pairwise label confusions of users with the same batch file, kept up to date by Batch
 
 def read_batches():
     batchdict={} #user -> batchfile -> Batch
+    index=read_index() if LAZY else {}
     batchfiles=sorted(glob.glob(DATADIR+"/batches-*/*.json"))
+    parsed={}
+    if LOAD_WORKERS>1 or SNAPSHOT_DIR:
+        parsed=parse_batches([b for b in batchfiles if index_meta(b,index) is None],LOAD_WORKERS,SNAPSHOT_DIR)
     for b in batchfiles:
         dirname,fname=b.split("/")[-2:]
         user=dirname.replace("batches-","")
-        batchdict.setdefault(user,{})[fname]=Batch(b)
+        batchdict.setdefault(user,{})[fname]=open_batch(b,index,parsed.get(b))
     return batchdict
-        
-       
+
+def index_meta(b,index):
+    meta=index.get(b)
+    if meta is not None and (meta["stat"]!=file_stat(b) or os.path.exists(b+".journal") or "labels" not in meta):
+        meta=None #changed since the index was written, parse it
+    return meta
+
+def open_batch(b,index={},parsed=None):
+    meta=index_meta(b,index)
+    batch=Batch(b,meta,parsed)
+    if LAZY:
+        batch.unload()
+    return batch
+
+def rescan():
+    """Load batch files added since the last scan, drop removed ones and reload the ones changed on disk by someone else.
+    Batches with edits not yet in their batch file are left alone."""
+    global all_batches
+    batchdict={user:dict(batches) for user,batches in all_batches.items()} #copy, requests keep iterating the old one
+    seen=set()
+    for b in sorted(glob.glob(DATADIR+"/batches-*/*.json")):
+        dirname,fname=b.split("/")[-2:]
+        user=dirname.replace("batches-","")
+        seen.add((user,fname))
+        batch=batchdict.get(user,{}).get(fname)
+        if batch is None:
+            print("Loading new batch",b,file=sys.stderr)
+            batchdict.setdefault(user,{})[fname]=open_batch(b)
+            continue
+        with batch.lock:
+            if file_stat(b)==batch.stat:
+                continue
+            if batch.is_dirty():
+                print("Batch",b,"changed on disk but has unsaved edits, not reloading",file=sys.stderr)
+                continue
+            print("Reloading changed batch",b,file=sys.stderr)
+            batch.detach()
+        batchdict[user][fname]=open_batch(b)
+    for user,batches in batchdict.items():
+        for fname,batch in list(batches.items()):
+            if (user,fname) in seen:
+                continue
+            with batch.lock:
+                if batch.is_dirty():
+                    print("Batch",batch.batchfile,"was removed but has unsaved edits, keeping it",file=sys.stderr)
+                    continue
+                print("Dropping removed batch",batch.batchfile,file=sys.stderr)
+                batch.detach()
+            del batches[fname]
+    all_batches={user:batches for user,batches in batchdict.items() if batches}
+
+def watch_batches():
+    while True:
+        time.sleep(RESCAN_SECONDS)
+        try:
+            rescan()
+        except Exception as e:
+            print("Batch rescan failed:",e,file=sys.stderr)
+
+def read_index():
+    try:
+        with open(INDEX_FILE) as f:
+            return json.load(f)
+    except (OSError,ValueError):
+        return {}
+
+def write_index():
+    index={}
+    for batches in all_batches.values():
+        for batch in batches.values():
+            meta=batch.meta()
+            if meta is not None:
+                index[batch.batchfile]=meta
+    tmp=INDEX_FILE+".tmp"
+    with open(tmp,"wt") as f:
+        json.dump(index,f)
+    os.replace(tmp,INDEX_FILE)
+
+
 class Batch:
 
-    def __init__(self,batchfile):
+    def __init__(self,batchfile,meta=None,parsed=None):
+        """meta: what Batch.meta() returned for the unchanged file, if given the pairs are not read until needed
+        parsed: (file stat, pair list) already read by the startup loader"""
         self.batchfile=batchfile
-        with open(batchfile) as f:
-            self.data=json.load(f) #this is a list of sentence pairs to annotate
+        self.lock=threading.RLock()
+        self.journal=Journal(batchfile)
+        self.user=os.path.basename(os.path.dirname(batchfile)).replace("batches-","")
+        self.fname=os.path.basename(batchfile)
+        self._data=None
+        self._precomputed=(None,{}) #(mtime of the .align file, blocks)
+        self.detached=False #set by detach(), writes must go to the replacement then
+        if meta is None:
+            self.load(parsed)
+            self.stats=Counter(pair_status(pair) for pair in self._data)
+            self.last_update=None
+            self.flags={} #pair index -> flag_entry()
+            for idx,pair in enumerate(self._data):
+                if "annotation" in pair:
+                    self._note_update(pair["annotation"].get("updated"))
+                entry=flag_entry(pair)
+                if entry is not None:
+                    self.flags[idx]=entry
+            self.labels={idx:entry for idx,entry in enumerate(map(agreement_entry,self._data)) if entry is not None} #pair index -> agreement_entry()
+        else:
+            self.length=meta["len"]
+            self.stats=Counter(meta["stats"])
+            self.last_update=datetime.datetime.fromisoformat(meta["last_update"]) if meta["last_update"] else None
+            self.flags={int(idx):tuple(entry) for idx,entry in meta["flags"].items()}
+            self.labels={int(idx):tuple(entry) for idx,entry in meta["labels"].items()}
+            self.stat=meta["stat"]
+        with stats_lock:
+            user_stats.setdefault(self.user,Counter()).update(self._user_counts())
+            flag_index.setdefault(self.user,{}).update(((self.fname,idx),entry) for idx,entry in self.flags.items())
+        live_agreement.add_batch(self.user,self.fname,self.labels)
 
-    def save(self):
+    @property
+    def data(self):
+        with self.lock:
+            if self._data is None:
+                self.load()
+            data=self._data #this is a list of sentence pairs to annotate
+        if resident is not None:
+            resident.touch(self)
+        return data
+
+    def load(self,parsed=None):
+        with self.lock:
+            if parsed is not None:
+                self.stat,self._data=parsed
+            else:
+                self.stat=file_stat(self.batchfile)
+                with open(self.batchfile) as f:
+                    self._data=json.load(f)
+            self.length=len(self._data)
+            replayed=0
+            for rec in self.journal.replay():
+                apply_record(self._data,rec)
+                replayed+=1
+            if replayed: #left behind by a crash or a stop before compaction, fold it in right away
+                self.compact()
+
+    def unload(self):
+        """Drop the pairs from memory, flushing the journal first. Call with self.lock held or before the app serves requests.
+        Records still queued in the group commit are not in the journal yet, the pairs stay then."""
+        if self._data is None or (journal_writer is not None and journal_writer.has_pending(self)):
+            return
+        if self.journal.records:
+            self.compact()
+        self._data=None
+        self._precomputed=(None,{})
+
+    def precomputed_blocks(self):
+        """Alignment blocks from precompute_alignments.py (<batchfile>.align), re-read when the file changes"""
+        fname=self.batchfile+".align"
+        mtime=os.path.getmtime(fname) if os.path.exists(fname) else None
+        with self.lock:
+            if mtime!=self._precomputed[0]:
+                self._precomputed=(mtime,read_precomputed(fname))
+            return self._precomputed[1]
+
+    def pair(self,pairseq):
+        return self.data[pairseq]
+
+    def pairs(self,offset=0,limit=None):
+        """[(pair index, pair)] of a slice of the batch"""
+        data=self.data
+        end=len(data) if limit is None else offset+limit
+        return list(enumerate(data[offset:end],offset))
+
+    def is_dirty(self):
+        """True while the batch file lags behind memory"""
+        return bool(self.journal.records) or (journal_writer is not None and journal_writer.has_pending(self))
+
+    def detach(self):
+        """Take the batch out of the statistics, the flag index and the agreement counts, before it is replaced or dropped. Call with self.lock held."""
+        self.detached=True
+        with stats_lock:
+            user_stats[self.user].subtract(self._user_counts())
+            for idx in self.flags:
+                flag_index[self.user].pop((self.fname,idx),None)
+        live_agreement.drop_batch(self.user,self.fname)
+        if resident is not None:
+            resident.forget(self)
+
+    def is_loaded(self):
+        return self._data is not None
+
+    def size(self):
+        return os.path.getsize(self.batchfile)
+
+    def meta(self):
+        """Lightweight description of the batch on disk, None while the file lags behind memory"""
+        with self.lock:
+            if self.journal.records or os.path.exists(self.journal.path):
+                return None
+            return {"stat":file_stat(self.batchfile),"len":self.length,"stats":dict(self.stats),"last_update":self.last_update.isoformat() if self.last_update else None,"flags":self.flags,"labels":self.labels}
+
+    def save(self,durable=False):
+        """Rewrite the batch file. durable: on disk, rename included, before returning, the journal may be dropped after that"""
+        started=time.perf_counter()
         s=json.dumps(self.data,ensure_ascii=False,indent=2,sort_keys=True)
-        with open(self.batchfile,"wt") as f:
+        serialized=time.perf_counter()
+        tmp=self.batchfile+".tmp"
+        with open(tmp,"wt") as f:
             print(s,file=f)
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp,self.batchfile)
+        if durable:
+            fsync_dir(os.path.dirname(os.path.abspath(self.batchfile)))
+        self.stat=file_stat(self.batchfile)
+        metrics.batch_write_seconds.observe(serialized-started,phase="serialize")
+        metrics.batch_write_seconds.observe(time.perf_counter()-serialized,phase="write")
+        metrics.batch_writes.inc()
+        metrics.batch_write_bytes.inc(self.stat[1])
+
+    def compact(self):
+        with self.lock:
+            if not self.journal.records:
+                return
+            self.save(durable=True) #the journal holds acknowledged edits, it goes only once they are safe in the batch file
+            self.journal.truncate()
+
+    def set_annotation(self,pairseq,annotation):
+        with self.lock:
+            if self.detached:
+                raise BatchDetached()
+            pair=self.data[pairseq]
+            annotation["version"]=(pair.get("annotation") or {}).get("version",0)+1
+            with self._tracking_stats(pairseq):
+                pair["annotation"]=annotation
+            ticket=self._persist({"pair":pairseq,"annotation":annotation})
+        self._wait(ticket)
+
+    def update_annotation(self,pairseq,fields,version):
+        """Apply changed fields only. version is the one the client started from, raises StaleWrite if someone saved in between. Returns the new version."""
+        with self.lock:
+            if self.detached:
+                raise BatchDetached()
+            pair=self.data[pairseq]
+            if pair.get("annotation") is None:
+                pair["annotation"]={}
+            annotation=pair["annotation"]
+            if annotation.get("version",0)!=version:
+                raise StaleWrite(dict(annotation))
+            fields=dict(fields,version=version+1)
+            with self._tracking_stats(pairseq):
+                annotation.update(fields)
+            ticket=self._persist({"pair":pairseq,"update":fields})
+        self._wait(ticket)
+        return version+1
+
+    def _persist(self,record):
+        #call with self.lock held
+        if journal_writer is None:
+            self.save()
+            return None
+        return journal_writer.enqueue(self,record)
+
+    def _wait(self,ticket):
+        if ticket is not None:
+            journal_writer.wait(ticket) #group commit, returns once the record is on disk
+
+    @contextlib.contextmanager
+    def _tracking_stats(self,pairseq):
+        #wrap a change of pair["annotation"], moves the pair between the cached counters, the flag index and the agreement counts in O(1) (O(users) for agreement)
+        pair=self.data[pairseq]
+        before_status=pair_status(pair)
+        before_user=self._user_counts()
+        yield
+        self.stats[before_status]-=1
+        self.stats[pair_status(pair)]+=1
+        self._note_update(pair["annotation"].get("updated"))
+        entry=flag_entry(pair)
+        if entry is None:
+            self.flags.pop(pairseq,None)
+        else:
+            self.flags[pairseq]=entry
+        with stats_lock:
+            user_stats[self.user].subtract(before_user)
+            user_stats[self.user].update(self._user_counts())
+            if entry is None:
+                flag_index[self.user].pop((self.fname,pairseq),None)
+            else:
+                flag_index[self.user][(self.fname,pairseq)]=entry
+        label=agreement_entry(pair)
+        if label is None:
+            self.labels.pop(pairseq,None)
+        else:
+            self.labels[pairseq]=label
+        live_agreement.set(self.user,self.fname,pairseq,label)
+
+    def _note_update(self,timestamp):
+        if timestamp is None:
+            return
+        timestamp=datetime.datetime.fromisoformat(timestamp)
+        if self.last_update is None or timestamp>self.last_update:
+            self.last_update=timestamp
+
+    def _user_counts(self):
+        return Counter(completed=self.stats["completed"],skipped=self.stats["skipped"],left=self.stats["left"],total=self.length,batches=1,completed_batches=int(self.is_completed))
+
+    @property
+    def is_completed(self):
+        return self.stats["completed"]+self.stats["skipped"]==self.length
 
     @property
     def get_batch_len(self):
-        batch_num = len(self.data)
-        return batch_num
+        return self.length
 
     @property
     def get_anno_stats(self):
-        completed = 0
-        skipped = 0
-        left = 0
-        for pair in self.data:
-            if "annotation" in pair:
-                if "label" in pair["annotation"]:
-                    if pair["annotation"]["label"]=="x":
-                        skipped += 1
-                    elif "|" in pair["annotation"]["label"] or pair["annotation"]["label"].strip() == "": # label not completed
-                        left+=1
-                    else:
-                        completed += 1
-                else:
-                    left += 1
-            else:
-                left += 1
-        return (completed, skipped, left)
+        return (self.stats["completed"], self.stats["skipped"], self.stats["left"])
 
     @property
     def get_update_timestamp(self):
-        timestamps = [datetime.datetime.fromisoformat(pair["annotation"]["updated"]) for pair in self.data if "annotation" in pair]
-        if not timestamps:
+        if self.last_update is None:
             return "no updates"
         else:
-            return max(timestamps).isoformat()
+            return self.last_update.isoformat()
 
     
+def get_user_stats(user):
+    """Counter of completed/skipped/left pairs, total pairs, batches and completed_batches"""
+    if STORAGE=="sqlite":
+        return all_batches.user_stats(user)
+    with stats_lock:
+        return Counter(user_stats[user])
+
+def get_flags(user=None):
+    """[(user, batchfile, pair index, flag_entry())] of all flagged pairs, or of one user's"""
+    if STORAGE=="sqlite":
+        return all_batches.flags(user)
+    with stats_lock:
+        users=[user] if user is not None else list(flag_index)
+        return [(u,batchfile,idx,entry) for u in users for (batchfile,idx),entry in flag_index.get(u,{}).items()]
+
+def get_agreement(relaxed=False):
+    """agreement_report() of every pair of users over their same-named batches"""
+    if STORAGE=="sqlite":
+        return agreement_report(all_batches.agreement(),relaxed)
+    return agreement_report(live_agreement.snapshot(),relaxed)
+
 def init():
-    global all_batches
+    global all_batches, journal_writer, resident
+    if STORAGE=="sqlite": #shared by all worker processes, none of the in-process machinery below applies
+        all_batches=SqliteStore(DB_FILE,DATADIR)
+        return
     all_batches=read_batches()
+    if LAZY:
+        resident=ResidentSet(MAX_RESIDENT,int(MAX_RESIDENT_MB)*2**20 if MAX_RESIDENT_MB else None)
+        write_index()
+        atexit.register(write_index) #registered first so it runs after the journal flush
+    if STORAGE=="journal":
+        journal_writer=GroupCommitWriter(JOURNAL_COMMIT_MS/1000,JOURNAL_COMPACT_SECONDS)
+        journal_writer.start()
+        atexit.register(journal_writer.flush)
+    if RESCAN_SECONDS>0:
+        threading.Thread(target=watch_batches,daemon=True,name="batch-watcher").start()
 
 init()            
 
+request_seconds=metrics.Histogram("paraanno_request_seconds","Request latency by route, streamed pages until the last byte",labels=("endpoint","method","status"))
+saves=metrics.Counter("paraanno_saves_total","Annotation saves by request kind and outcome",labels=("kind","result"))
+metrics.Counter("paraanno_alignment_cache_hits_total","Context view spans found in the alignment cache",func=lambda: alignment_cache.hits)
+metrics.Counter("paraanno_alignment_cache_misses_total","Context view spans computed",func=lambda: alignment_cache.misses)
+metrics.Gauge("paraanno_resident_batches","Batches with their pairs in memory",
+              lambda: None if STORAGE=="sqlite" else len(resident) if resident is not None else sum(len(batches) for batches in all_batches.values()))
+metrics.Gauge("paraanno_resident_bytes","Batch file bytes of the resident batches (lazy mode)",lambda: resident.bytes if resident is not None else None)
+metrics.Gauge("paraanno_process_resident_memory_bytes","Resident memory of this worker",metrics.process_rss)
+metrics.Gauge("paraanno_pairs","Pairs by annotation status, all users",
+              lambda: {(status,):sum(get_user_stats(user)[status] for user in all_batches) for status in ("completed","skipped","left")},labels=("status",))
+
+@app.before_request
+def start_timer():
+    if METRICS:
+        flask.g.request_started=time.perf_counter()
+
+@app.after_request
+def record_latency(response):
+    if not METRICS or "request_started" not in flask.g:
+        return response
+    started=flask.g.request_started
+    labels=dict(endpoint=request.endpoint or "unmatched",method=request.method,status=response.status_code)
+    response.call_on_close(lambda: request_seconds.observe(time.perf_counter()-started,**labels)) #after a streamed body is sent, not when it starts
+    return response
+
+@app.route("/metrics")
+def metrics_page():
+    if not METRICS:
+        flask.abort(404)
+    return flask.Response(metrics.render(),mimetype="text/plain; version=0.0.4")
+
 @app.route('/')
 def hello_world():
     global all_batches
 
     batch_stats = {} # user -> (completed, non-completed)
-    for user, batches in all_batches.items():
-        no_completed, no_left = 0, 0
-        for batch in batches.values():
-            if (batch.get_anno_stats[0] + batch.get_anno_stats[1]) == batch.get_batch_len: # completed + skipped == total
-                no_completed += 1
-            else:
-                no_left += 1
-        batch_stats[user] = (no_completed, no_left)
+    for user in all_batches.keys():
+        counts = get_user_stats(user)
+        batch_stats[user] = (counts["completed_batches"], counts["batches"]-counts["completed_batches"])
     return render_template("index.html",
                            app_root=APP_ROOT,
                            users=sorted(all_batches.keys()),
@@ -119,41 +502,117 @@ def batchlist(user):
     
     return render_template("batch_list.html",app_root=APP_ROOT,batches=batch_anno_stats,user=user,stats=(t_done,t_skipped,t_left,total))
 
+def page_args():
+    """offset and limit of a paginated listing from the query string"""
+    try:
+        offset=max(0,int(request.args.get("offset",0)))
+        limit=max(1,int(request.args.get("limit",PAGE_SIZE)))
+    except ValueError:
+        flask.abort(400)
+    return offset,limit
+
+def stream_template(template_name,**context):
+    """Like render_template, but the page is sent while it renders, so rows produced by a generator reach the browser right away"""
+    app.update_template_context(context)
+    template=app.jinja_env.get_template(template_name)
+    return flask.Response(flask.stream_with_context(template.generate(context)))
+
+@app.context_processor
+def template_helpers():
+    return {"asset":lambda path: asset_url(path,APP_ROOT)}
+
+def page_etag(template_name,*parts):
+    """ETag of a page rendered from template_name and nothing but parts, and the asset urls (local or CDN) it links to"""
+    h=hashlib.sha1(str(file_stat(os.path.join(app.root_path,app.template_folder,template_name))).encode())
+    h.update(json.dumps(vendored()).encode("utf-8")) #fetch_assets.py run since the page was cached
+    for part in parts:
+        h.update(json.dumps(part,ensure_ascii=False,sort_keys=True,default=str).encode("utf-8"))
+    return h.hexdigest()
+
+def conditional(etag,render,last_modified=None):
+    """304 if the browser has this version of the page already, else render() it. Browsers revalidate every time but skip the body when nothing changed."""
+    if last_modified is not None:
+        last_modified=last_modified.astimezone(datetime.timezone.utc).replace(microsecond=0)
+    if is_resource_modified(request.environ,etag=etag,last_modified=last_modified):
+        response=flask.make_response(render())
+    else:
+        response=flask.Response(status=304)
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified=last_modified
+    response.cache_control.private=True
+    response.cache_control.no_cache=True
+    return response
+
 @app.route("/ann/<user>/<batchfile>")
 def jobsinbatch(user,batchfile):
     global all_batches
-    pairs=all_batches[user][batchfile].data
-    pairdata=[]
-    for idx,pair in enumerate(pairs):
-        text1=pair["txt1"]
-        text2=pair["txt2"]
-        ann=pair.get("annotation",{})
-        lab=""
-        flag="false"
-        if ann:
-            lab=ann.get("label","?")
-            flag=ann.get("flagged", "false")
-        pairdata.append((idx,ann.get("updated","not updated"),flag,lab,text1[:50],text2[:50]))
-    return render_template("doc_list_in_batch.html",app_root=APP_ROOT,user=user,batchfile=batchfile,pairdata=pairdata)
+    batch=all_batches[user][batchfile]
+    offset,limit=page_args()
+    def pairdata():
+        for idx,pair in batch.pairs(offset,limit):
+            text1=pair["txt1"]
+            text2=pair["txt2"]
+            ann=pair.get("annotation") or {}
+            lab=""
+            flag="false"
+            if ann:
+                lab=ann.get("label","?")
+                flag=ann.get("flagged", "false")
+            yield (idx,ann.get("updated","not updated"),flag,lab,text1[:50],text2[:50])
+    return stream_template("doc_list_in_batch.html",app_root=APP_ROOT,user=user,batchfile=batchfile,pairdata=pairdata(),offset=offset,limit=limit,total=batch.get_batch_len)
+
+def write_annotation(user,batchfile,method,*args):
+    """batch.method(*args) on the current Batch of user/batchfile. If a rescan detached the batch while we waited for its lock,
+    the write goes to the batch that replaced it instead, never to the stale copy."""
+    for _ in range(100):
+        batch=all_batches.get(user,{}).get(batchfile)
+        if batch is None: #dropped by the rescan
+            flask.abort(404)
+        try:
+            return getattr(batch,method)(*args)
+        except BatchDetached:
+            time.sleep(0.01) #the rescan publishes the new all_batches after it has reloaded everything
+    flask.abort(503)
 
 @app.route("/saveann/<user>/<batchfile>/<pairseq>",methods=["POST"])
 def save_document(user,batchfile,pairseq):
     global all_batches
     pairseq=int(pairseq)
     annotation=request.json
-    pair=all_batches[user][batchfile].data[pairseq]
     annotation["updated"]=datetime.datetime.now().isoformat()
-    pair["annotation"]=annotation
-    all_batches[user][batchfile].save()
+    write_annotation(user,batchfile,"set_annotation",pairseq,annotation)
+    saves.inc(kind="post",result="ok")
     return "",200
 
+@app.route("/saveann/<user>/<batchfile>/<pairseq>",methods=["PATCH"])
+def patch_document(user,batchfile,pairseq):
+    # body: {"version": <version the client edited>, "fields": {changed fields only}}
+    global all_batches
+    pairseq=int(pairseq)
+    delta=request.get_json(silent=True)
+    fields=delta.get("fields",{}) if isinstance(delta,dict) else None
+    #checked before anything is touched, a bad value half-applied would leave memory, disk and the counters disagreeing
+    if not isinstance(fields,dict) or type(delta.get("version")) is not int or not set(fields)<=EDITABLE_FIELDS or not all(isinstance(v,str) for v in fields.values()):
+        saves.inc(kind="patch",result="invalid")
+        return flask.jsonify(error="expected an int version and string fields from "+", ".join(sorted(EDITABLE_FIELDS))),400
+    fields["updated"]=datetime.datetime.now().isoformat()
+    try:
+        version=write_annotation(user,batchfile,"update_annotation",pairseq,fields,delta["version"])
+    except StaleWrite as e:
+        saves.inc(kind="patch",result="conflict")
+        return flask.jsonify(version=e.annotation.get("version",0),annotation=e.annotation),409
+    saves.inc(kind="patch",result="ok")
+    return flask.jsonify(version=version,updated=fields["updated"]),200
+
 @app.route("/ann/<user>/<batchfile>/<pairseq>")
 def fetch_document(user,batchfile,pairseq):
     global all_batches
     pairseq=int(pairseq)
-    pair=all_batches[user][batchfile].data[pairseq]
-    name=pair.get("meta", {}).get("name", "").replace("\\", "").strip()
+    batch=all_batches[user][batchfile]
+    current=client_pair(pairseq,batch.pair(pairseq))
     
+    # meta of a pair:
     # {
     # "d1": [
     #   "hs",
@@ -166,51 +625,64 @@ def fetch_document(user,batchfile,pairseq):
     # "sim": 0.9922545481090577
     # }
 
-    text1=pair["txt1"]
-    text2=pair["txt2"]
-
-    annotation=pair.get("annotation",{})
-    
-    return render_template("doc.html",app_root=APP_ROOT,text1=text1,text2=text2,pairseq=pairseq,batchfile=batchfile,user=user,annotation=annotation,name=name,is_last=(pairseq==len(all_batches[user][batchfile].data)-1))
-    
+    text1=current["txt1"]
+    text2=current["txt2"]
+    annotation=current["annotation"]
+    batch_len=batch.get_batch_len
+    is_last=(pairseq==batch_len-1)
+
+    # the pair carries the annotation with its version and updated timestamp, so any save or reload of the batch changes the etag
+    etag=page_etag("doc.html",APP_ROOT,user,batchfile,batch_len,PREFETCH,current)
+    updated=annotation.get("updated")
+    return conditional(etag,lambda: render_template("doc.html",app_root=APP_ROOT,text1=text1,text2=text2,pairseq=pairseq,batchfile=batchfile,user=user,annotation=annotation,name=current["name"],is_last=is_last,
+                                                    current=current,batch_len=batch_len,prefetch=PREFETCH),
+                       last_modified=datetime.datetime.fromisoformat(updated) if updated else None)
+
+@app.route("/api/ann/<user>/<batchfile>/<pairseq>")
+def api_pairs(user,batchfile,pairseq):
+    """The pair and its annotation, ?window=N for it and the N-1 pairs after it. doc.html prefetches with this and switches pairs without a page load."""
+    global all_batches
+    batch=all_batches[user][batchfile]
+    try:
+        pairseq=int(pairseq)
+        window=max(1,min(int(request.args.get("window",1)),PAGE_SIZE))
+    except ValueError:
+        flask.abort(400)
+    if pairseq<0:
+        flask.abort(400)
+    response=flask.jsonify(length=batch.get_batch_len,pairs=[client_pair(idx,pair) for idx,pair in batch.pairs(pairseq,window)])
+    response.cache_control.no_store=True
+    return response
 
 
 @app.route("/flags")
 def flags():
-    global all_batches
     pairdata=[]
-    for user in all_batches.keys():
-        for batchfile in all_batches[user].keys():
-            pairs=all_batches[user][batchfile].data
-            for idx,pair in enumerate(pairs):
-                text1=pair["txt1"]
-                text2=pair["txt2"]
-                ann=pair.get("annotation",{})
-                if ann:
-                    lab=ann.get("label","?")
-                    flag=ann.get("flagged", "false")
-                    if flag=="true":
-                        pairdata.append((user, batchfile, idx,ann.get("updated","not updated"),flag,lab,text1[:50],text2[:50]))
+    for user,batchfile,idx,(updated,lab,text1,text2) in get_flags():
+        pairdata.append((user, batchfile, idx,updated,"true",lab,text1,text2))
     pairdata = sorted(pairdata, key = lambda x: (x[3],x[1]), reverse=True)
-    return render_template("all_flags.html",app_root=APP_ROOT,pairdata=pairdata)
+    offset,limit=page_args()
+    return stream_template("all_flags.html",app_root=APP_ROOT,pairdata=iter(pairdata[offset:offset+limit]),offset=offset,limit=limit,total=len(pairdata))
 
 @app.route("/ann/<user>/flags")
 def user_flags(user):
-    global all_batches
     pairdata=[]
-    for batchfile in all_batches[user].keys():
-        pairs=all_batches[user][batchfile].data
-        for idx,pair in enumerate(pairs):
-            text1=pair["txt1"]
-            text2=pair["txt2"]
-            ann=pair.get("annotation",{})
-            if ann:
-                lab=ann.get("label","?")
-                flag=ann.get("flagged", "false")
-                if flag=="true":
-                    pairdata.append((user, batchfile, idx,ann.get("updated","not updated"),flag,lab,text1[:50],text2[:50]))
+    for _,batchfile,idx,(updated,lab,text1,text2) in get_flags(user):
+        pairdata.append((user, batchfile, idx,updated,"true",lab,text1,text2))
     pairdata = sorted(pairdata, key = lambda x: x[3], reverse=True)
-    return render_template("user_flags.html",app_root=APP_ROOT,user=user,pairdata=pairdata)
+    offset,limit=page_args()
+    return stream_template("user_flags.html",app_root=APP_ROOT,user=user,pairdata=iter(pairdata[offset:offset+limit]),offset=offset,limit=limit,total=len(pairdata))
+
+@app.route("/agreement")
+def agreement():
+    relaxed=request.args.get("relaxed")=="1"
+    return render_template("agreement.html",app_root=APP_ROOT,relaxed=relaxed,report=get_agreement(relaxed))
+
+@app.route("/api/agreement")
+def api_agreement():
+    response=flask.jsonify(get_agreement(request.args.get("relaxed")=="1"))
+    response.cache_control.no_store=True
+    return response
 
 
 def get_focus_region(focus, anchor):
@@ -238,82 +710,22 @@ def get_focus_region(focus, anchor):
 def fetch_context(user,batchfile,pairseq):
     global all_batches
     pairseq=int(pairseq)
-    pair=all_batches[user][batchfile].data[pairseq]
-
-    text1=pair.get("document_context1", "")
-    text2=pair.get("document_context2", "")
-    
-    text1=re.sub(r"\n+","\n",text1)
-    text2=re.sub(r"\n+","\n",text2)
+    batch=all_batches[user][batchfile]
+    pair=batch.pair(pairseq)
+    is_last=(pairseq==batch.get_batch_len-1)
 
-    text1=text1.replace("<i>"," ").replace("</i>"," ")
-    text2=text2.replace("<i>"," ").replace("</i>"," ")
+    # the context view does not show the annotation, saving the pair leaves its etag alone
+    etag=page_etag("context.html",APP_ROOT,user,batchfile,pairseq,is_last,ALIGN_ENGINE,{k:v for k,v in pair.items() if k!="annotation"})
 
-    text1=re.sub(r" +"," ",text1)
-    text2=re.sub(r" +"," ",text2)
+    def render():
+        text1=normalize_context(contexts.resolve(pair, 1))
+        text2=normalize_context(contexts.resolve(pair, 2))
 
-    blocks=matches(text1,text2,15) #matches are (idx1,idx2,len)
-    spandata1,min1,max1=build_spans(text1,list((b[0],b[2]) for b in blocks))
-    spandata2,min2,max2=build_spans(text2,list((b[1],b[2]) for b in blocks))
-    
-    # focus region
-    left_min, left_max = get_focus_region(pair.get("focus1", None), pair.get("anchor1", None))
-    right_min, right_max = get_focus_region(pair.get("focus2", None), pair.get("anchor2", None))
-    
-    
-    return render_template("context.html", app_root=APP_ROOT, left_text=text1, right_text=text2, left_spandata=spandata1, right_spandata=spandata2, pairseq=pairseq, batchfile=batchfile, user=user, min_mlen=min(min1,min2), max_mlen=max(max1,max2)+1, mlenv=min(max(max1,max2),30), is_last=(pairseq==len(all_batches[user][batchfile].data)-1), selection_left_min=left_min, selection_left_max=left_max, selection_right_min=right_min, selection_right_max=right_max)
-    
-   
+        spandata1,min1,max1,spandata2,min2,max2=context_spans(text1,text2,15,alignment_cache,ALIGN_ENGINE,batch.precomputed_blocks)
 
+        # focus region
+        left_min, left_max = get_focus_region(pair.get("focus1", None), pair.get("anchor1", None))
+        right_min, right_max = get_focus_region(pair.get("focus2", None), pair.get("anchor2", None))
 
-
-def matches(s1,s2,minlen=5):
-    m=difflib.SequenceMatcher(None,s1,s2,autojunk=False)
-
-    #returns list of (idx1,idx2,len) perfect matches
-    return sorted(matches_r(m,s1,s2,minlen,0,len(s1),0,len(s2)), key=lambda match: (match[2], match[0]))
-
-def matches_r(m,s1,s2,min_len,s1_beg,s1_end,s2_beg,s2_end):
-    lm=m.find_longest_match(s1_beg,s1_end,s2_beg,s2_end)
-    if lm.size<min_len:
-        return []
-    else:
-        s1_left=s1_beg,lm.a
-        s1_right=lm.a+lm.size,s1_end
-        s1_all=(s1_beg,s1_end)
-        
-        s2_left=s2_beg,lm.b
-        s2_right=lm.b+lm.size,s2_end
-        s2_all=(s2_beg,s2_end)
-        
-        matches=[(lm.a,lm.b,lm.size)]
-        for i1,i2 in ((s1_left,s2_left),(s1_left,s2_right),(s1_right,s2_left),(s1_right,s2_right)):
-            #try all combinations of what remains
-            if i1[1]-i1[0]<min_len:
-                continue #too short to produce match
-            if i2[1]-i2[0]<min_len:
-                continue #too short to produce match
-            sub=matches_r(m,s1,s2,min_len,*i1,*i2)
-            matches.extend(sub)
-        return matches
-
-def build_spans(s,blocks):
-    """s:string, blocks are pairs of (idx,len) of perfect matches"""
-    if not blocks:
-        return [], 0, 0
-    #allright, this is pretty dumb alg!
-    matched_indices=[0]*len(s)
-    for i,l in blocks:
-        for idx in range(i,i+l):
-            matched_indices[idx]=max(matched_indices[idx],l)
-    spandata=[]
-    for c,matched_len in zip(s,matched_indices):
-        #matched_len=(matched_len//5)*5
-        if not spandata or spandata[-1][1]!=matched_len: #first or span with opposite match polarity -> must make new!
-            spandata.append(([],matched_len))
-        spandata[-1][0].append(c)
-    merged_spans=[(html.escape("".join(chars)),matched_len) for chars,matched_len in spandata]
-    return merged_spans, min(matched_indices),max(matched_indices) #min is actually always 0, but it's here for future need
-
-#matches("Minulla on koira mutta sinulla on kissa.","Sinulla on kissa ja minulla on koira.")
-
+        return render_template("context.html", app_root=APP_ROOT, left_text=text1, right_text=text2, left_spandata=spandata1, right_spandata=spandata2, pairseq=pairseq, batchfile=batchfile, user=user, min_mlen=min(min1,min2), max_mlen=max(max1,max2)+1, mlenv=min(max(max1,max2),30), is_last=is_last, selection_left_min=left_min, selection_left_max=left_max, selection_right_min=right_min, selection_right_max=right_max)
+    return conditional(etag,render)
@@ -0,0 +1,38 @@
+import os
+import base64
+import hashlib
+
+# Front-end libraries served from paraanno/static/vendor, fetch them with fetch_assets.py.
+# The version is part of every path, so the files can be cached forever.
+
+VENDOR_DIR=os.path.join(os.path.dirname(os.path.abspath(__file__)),"static","vendor")
+
+FA="https://stackpath.bootstrapcdn.com/font-awesome/4.7.0"
+ASSETS={ #path under VENDOR_DIR -> (upstream url, subresource integrity or None)
+    "jquery-3.4.1/jquery.min.js":("https://cdnjs.cloudflare.com/ajax/libs/jquery/3.4.1/jquery.min.js","sha256-CSXorXvZcTkaix6Yvo6HppcZGetbYMGWSFlBw8HfCJo="),
+    "popper.js-1.12.9/popper.min.js":("https://cdnjs.cloudflare.com/ajax/libs/popper.js/1.12.9/umd/popper.min.js","sha384-ApNbgh9B+Y1QKtv3Rn7W3mgPxhU9K/ScQsAP7hUibX39j7fakFPskvXusvfa0b4Q"),
+    "bootstrap-4.0.0/css/bootstrap.min.css":("https://maxcdn.bootstrapcdn.com/bootstrap/4.0.0/css/bootstrap.min.css","sha384-Gn5384xqQ1aoWXA+058RXPxPg6fy4IWvTNh0E263XmFcJlSAwiGgFAW/dAiS6JXm"),
+    "bootstrap-4.0.0/js/bootstrap.min.js":("https://maxcdn.bootstrapcdn.com/bootstrap/4.0.0/js/bootstrap.min.js","sha384-JZR6Spejh4U02d8jOt6vLEHfe/JQGiRRSQQxSfFWpi1MquVdAyjUar5+76PVCmYl"),
+    "font-awesome-4.7.0/css/font-awesome.min.css":(FA+"/css/font-awesome.min.css",None),
+    #the css refers to these as ../fonts/
+    "font-awesome-4.7.0/fonts/fontawesome-webfont.eot":(FA+"/fonts/fontawesome-webfont.eot",None),
+    "font-awesome-4.7.0/fonts/fontawesome-webfont.woff2":(FA+"/fonts/fontawesome-webfont.woff2",None),
+    "font-awesome-4.7.0/fonts/fontawesome-webfont.woff":(FA+"/fonts/fontawesome-webfont.woff",None),
+    "font-awesome-4.7.0/fonts/fontawesome-webfont.ttf":(FA+"/fonts/fontawesome-webfont.ttf",None),
+    "font-awesome-4.7.0/fonts/fontawesome-webfont.svg":(FA+"/fonts/fontawesome-webfont.svg",None),
+}
+
+
+def asset_url(path,app_root=""):
+    """The local copy if fetch_assets.py has put it in place, the upstream url otherwise"""
+    if os.path.exists(os.path.join(VENDOR_DIR,path)):
+        return f"{app_root}/static/vendor/{path}"
+    return ASSETS[path][0]
+
+def vendored():
+    """[paths of ASSETS with a local copy], asset_url() points to these"""
+    return [path for path in sorted(ASSETS) if os.path.exists(os.path.join(VENDOR_DIR,path))]
+
+def check_integrity(data,integrity):
+    algo,digest=integrity.split("-",1)
+    return base64.b64encode(hashlib.new(algo,data).digest()).decode("ascii")==digest
@@ -0,0 +1,57 @@
+import hashlib
+import os
+import functools
+
+
+class ContextStore:
+    """Document contexts stored once, keyed by the sha256 of the text: <root>/<ref[:2]>/<ref>.txt
+    A pair then carries document_context1_ref/document_context2_ref instead of document_context1/document_context2."""
+
+    def __init__(self,root):
+        self.root=root
+        self.get=functools.lru_cache(maxsize=256)(self._read) #the same document backs many pairs in a row
+
+    def path(self,ref):
+        return os.path.join(self.root,ref[:2],ref+".txt")
+
+    def put(self,text):
+        ref=hashlib.sha256(text.encode("utf-8")).hexdigest()
+        fname=self.path(ref)
+        if not os.path.exists(fname):
+            os.makedirs(os.path.dirname(fname),exist_ok=True)
+            tmp=f"{fname}.{os.getpid()}.tmp"
+            with open(tmp,"wt",encoding="utf-8",newline="") as f:
+                f.write(text)
+            os.replace(tmp,fname)
+        return ref
+
+    def _read(self,ref):
+        with open(self.path(ref),"rt",encoding="utf-8",newline="") as f:
+            return f.read()
+
+    def resolve(self,pair,side):
+        """Context text of side 1 or 2, whether it is inline or a reference"""
+        ref=pair.get(f"document_context{side}_ref")
+        if ref is not None:
+            return self.get(ref)
+        return pair.get(f"document_context{side}","")
+
+    def externalize(self,pair):
+        """Move inline contexts into the store, returns True if the pair changed"""
+        changed=False
+        for side in (1,2):
+            key=f"document_context{side}"
+            if pair.get(key):
+                pair[key+"_ref"]=self.put(pair.pop(key))
+                changed=True
+        return changed
+
+    def inline(self,pair):
+        """Replace references by the texts, returns True if the pair changed"""
+        changed=False
+        for side in (1,2):
+            key=f"document_context{side}"
+            if key+"_ref" in pair:
+                pair[key]=self.get(pair.pop(key+"_ref"))
+                changed=True
+        return changed
@@ -0,0 +1,179 @@
+import numpy
+import threading
+import datetime
+from collections import Counter
+
+# Inter-annotator agreement over integer-coded labels, shared by agreement.py and the app.
+# A label matrix has one row per annotator and one column per item, -1 where the annotator did not label the item.
+
+SORT_ORDER = ['4', '4s', '4i', '4is', '4A', '4<', '4>','4<i', '4>i','4<s', '4>s','4<is', '4>is', '3', '2', '1']
+
+def label_sort_key(label):
+    #known labels in SORT_ORDER, anything else after them
+    return (SORT_ORDER.index(label) if label in SORT_ORDER else len(SORT_ORDER), label)
+
+
+def normalize_label(label, relaxed=False):
+    """Labels compare equal regardless of case, whitespace and the order of the characters. relaxed also ignores s and i and the direction of <>."""
+    label = "".join(sorted("".join(label.lower().split())))
+    if relaxed:
+        label = label.replace("s", "").replace("i", "").replace("<", "A").replace(">", "A")
+    return label
+
+def iso_week(timestamp):
+    """"2021 week 7" of an iso timestamp, "unknown" stays as it is"""
+    if timestamp == "unknown":
+        return timestamp
+    year, week, _ = datetime.datetime.fromisoformat(timestamp).isocalendar()
+    return f"{year} week {week}"
+
+def week_sort_key(week):
+    # chronological, "2021 week 10" after "2021 week 9", unknown first
+    if week == "unknown":
+        return (0, 0)
+    year, _, number = week.split()
+    return (int(year), int(number))
+
+
+def one_hot(matrix, n_labels):
+    """(annotators, items, labels) bool, all False where the label is missing"""
+    return matrix[:, :, None] == numpy.arange(n_labels)
+
+def pairwise_confusions(matrix, n_labels):
+    """(annotators, annotators, labels, labels) int64: confusions[a, b, i, j] is the number of items a labeled i and b labeled j.
+    One matrix product for all pairs."""
+    n_annotators = matrix.shape[0]
+    flat = one_hot(matrix, n_labels).transpose(0, 2, 1).reshape(n_annotators * n_labels, matrix.shape[1]).astype(numpy.float64)
+    products = flat @ flat.T
+    return numpy.rint(products).astype(numpy.int64).reshape(n_annotators, n_labels, n_annotators, n_labels).transpose(0, 2, 1, 3)
+
+def cohen_kappa(confusion):
+    """Cohen's kappa of one confusion matrix, nan when chance agreement is already perfect"""
+    n = confusion.sum()
+    if n == 0:
+        return float("nan")
+    observed = numpy.trace(confusion) / n
+    expected = (confusion.sum(axis=1) @ confusion.sum(axis=0)) / n**2
+    if expected == 1:
+        return float("nan")
+    return float((observed - expected) / (1 - expected))
+
+def krippendorff_alpha(matrix, n_labels):
+    """Krippendorff's alpha for nominal labels over all annotators of a label matrix, nan if undefined (fewer than two pairable values or a single label)"""
+    counts = one_hot(matrix, n_labels).sum(axis=0).astype(numpy.float64) # items x labels
+    per_item = counts.sum(axis=1)
+    counts = counts[per_item >= 2] # only items labeled at least twice are pairable
+    per_item = per_item[per_item >= 2]
+    if len(per_item) == 0:
+        return float("nan")
+    weighted = counts / (per_item - 1)[:, None]
+    coincidence = weighted.T @ counts - numpy.diag(weighted.sum(axis=0))
+    marginals = coincidence.sum(axis=0)
+    n = marginals.sum()
+    expected = n**2 - (marginals**2).sum()
+    if expected == 0:
+        return float("nan")
+    disagreement = coincidence.sum() - numpy.trace(coincidence)
+    return float(1 - (n - 1) * disagreement / expected)
+
+
+def confusion_summary(counts):
+    """n, observed agreement and Cohen's kappa of a Counter of (label1, label2) -> items, None where undefined"""
+    names = sorted({label for pair in counts for label in pair}, key=label_sort_key)
+    codes = {label: i for i, label in enumerate(names)}
+    confusion = numpy.zeros((len(names), len(names)), dtype=numpy.int64)
+    for (label1, label2), n in counts.items():
+        confusion[codes[label1], codes[label2]] += n
+    n = int(confusion.sum())
+    kappa = cohen_kappa(confusion)
+    return {"n": n,
+            "agreement": float(numpy.trace(confusion) / n) if n else None,
+            "kappa": None if numpy.isnan(kappa) else kappa} # None, not nan, goes into json
+
+def relax_counts(counts):
+    relaxed = Counter()
+    for (label1, label2), n in counts.items():
+        relaxed[(normalize_label(label1, True), normalize_label(label2, True))] += n
+    return relaxed
+
+def agreement_report(confusions, relaxed=False):
+    """Per-pair summaries of LiveAgreement.snapshot() style confusions: {"total": [...], "weeks": {week: [...]}, "batches": {batchfile: [...]}}.
+    The lists have one summary per annotator pair, with "annotators": [user1, user2]. Weeks are in chronological order."""
+    def summaries(pairs):
+        return [dict(confusion_summary(relax_counts(counts) if relaxed else counts), annotators=list(users)) for users, counts in sorted(pairs.items())]
+    total = {}
+    report = {"weeks": {}, "batches": {}}
+    for (kind, scope), pairs in sorted(confusions.items(), key=lambda item: (item[0][0], week_sort_key(item[0][1]) if item[0][0] == "week" else item[0][1])):
+        report[{"batch": "batches", "week": "weeks"}[kind]][scope] = summaries(pairs)
+        if kind == "batch": # every pairing is in exactly one batch
+            for users, counts in pairs.items():
+                total.setdefault(users, Counter()).update(counts)
+    report["total"] = summaries(total)
+    return report
+
+
+class LiveAgreement:
+    """Pairwise confusion counts of the annotators who have a batch file of the same name, per batch and per ISO week, updated on every save.
+    A batch handed to several annotators is the same file copied, so items are matched by pair index, and only count if the texts are the same too.
+    Labels are normalize_label()ed, the relaxed variant is derived when reporting. Krippendorff's alpha is not kept, it does not split into pairwise counts."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.labels = {} # batchfile -> user -> {pair index: (label, week, text fingerprint)}
+        self.confusions = {} # ("batch", batchfile) or ("week", week) -> (user1, user2) -> Counter of (label1, label2), user1 < user2
+
+    def _count(self, fname, user, idx, entry, sign):
+        # add or remove the pairings of one user's label with everyone else's on the same item
+        label, week, texts = entry
+        for other, labels in self.labels.get(fname, {}).items():
+            other_entry = labels.get(idx)
+            if other == user or other_entry is None or other_entry[2] != texts:
+                continue
+            users, cell = ((user, other), (label, other_entry[0])) if user < other else ((other, user), (other_entry[0], label))
+            scopes = [("batch", fname)]
+            if week == other_entry[1]:
+                scopes.append(("week", week))
+            for scope in scopes:
+                pairs = self.confusions.setdefault(scope, {})
+                counts = pairs.setdefault(users, Counter())
+                counts[cell] += sign
+                if counts[cell] == 0:
+                    del counts[cell]
+                    if not counts:
+                        del pairs[users]
+                        if not pairs:
+                            del self.confusions[scope]
+
+    def add_batch(self, user, fname, entries):
+        """entries: {pair index: agreement_entry()} of a batch being opened"""
+        with self.lock:
+            labels = self.labels.setdefault(fname, {}).setdefault(user, {})
+            for idx, entry in entries.items():
+                self._count(fname, user, idx, entry, 1)
+                labels[idx] = entry
+
+    def drop_batch(self, user, fname):
+        with self.lock:
+            labels = self.labels.get(fname, {}).pop(user, {})
+            for idx, entry in labels.items():
+                self._count(fname, user, idx, entry, -1)
+
+    def set(self, user, fname, idx, entry):
+        """The label of one pair changed, entry is None when it no longer counts"""
+        with self.lock:
+            labels = self.labels.setdefault(fname, {}).setdefault(user, {})
+            old = labels.get(idx)
+            if old == entry:
+                return
+            if old is not None:
+                self._count(fname, user, idx, old, -1)
+            if entry is None:
+                labels.pop(idx, None)
+            else:
+                self._count(fname, user, idx, entry, 1)
+                labels[idx] = entry
+
+    def snapshot(self):
+        """Copy of the confusions, for agreement_report()"""
+        with self.lock:
+            return {scope: {users: Counter(counts) for users, counts in pairs.items()} for scope, pairs in self.confusions.items()}
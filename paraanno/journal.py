@@ -0,0 +1,150 @@
+import json
+import os
+import threading
+import time
+import sys
+from . import metrics
+
+
+def apply_record(data,rec):
+    """Replay one journal record onto a batch's pair list"""
+    if "update" in rec:
+        data[rec["pair"]].setdefault("annotation",{}).update(rec["update"])
+    else:
+        data[rec["pair"]]["annotation"]=rec["annotation"]
+
+
+def fsync_dir(path):
+    """Make a rename or removal in directory path durable"""
+    fd=os.open(path,os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Journal:
+    """Append-only log of annotation records kept next to a batch file (<batchfile>.journal), one json record per line"""
+
+    def __init__(self,batchfile):
+        self.path=batchfile+".journal"
+        self.records=0 #records written since the last compaction
+
+    def replay(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            for line in f:
+                line=line.strip()
+                if not line:
+                    continue
+                try:
+                    rec=json.loads(line)
+                except json.JSONDecodeError: #torn write at crash, nothing after it was acknowledged
+                    print("Ignoring broken journal tail in",self.path,file=sys.stderr)
+                    break
+                self.records+=1
+                yield rec
+
+    def append(self,records):
+        lines="".join(json.dumps(rec,ensure_ascii=False)+"\n" for rec in records).encode("utf-8")
+        with open(self.path,"ab") as f:
+            f.write(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        self.records+=len(records)
+        metrics.journal_records.inc(len(records))
+        metrics.journal_bytes.inc(len(lines))
+        metrics.journal_fsyncs.inc()
+
+    def truncate(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+            fsync_dir(os.path.dirname(os.path.abspath(self.path)))
+        self.records=0
+
+
+class GroupCommitWriter(threading.Thread):
+    """Collects journal records from request threads and writes them in groups, one fsync per batch per group.
+    Every compact_interval seconds the journaled batches are compacted back into their canonical json files."""
+
+    def __init__(self,commit_interval=0.02,compact_interval=300):
+        super().__init__(daemon=True,name="journal-writer")
+        self.commit_interval=commit_interval
+        self.compact_interval=compact_interval
+        self.cond=threading.Condition()
+        self.pending={} #batch -> [records]
+        self.writing=set() #batches whose records commit() is appending right now
+        self.next_group=0 #the group new records go into
+        self.done_groups=0 #groups 0..done_groups-1 are on disk
+        self.failed={} #group -> exception
+        self.journaled=set() #batches with a non-empty journal
+        self.last_compaction=time.time()
+        self.commit_lock=threading.Lock() #one commit at a time (writer thread vs. flush())
+
+    def enqueue(self,batch,record):
+        """Queue a record, call with batch.lock held so journal order follows the in-memory update order. Returns a ticket for wait()"""
+        with self.cond:
+            self.pending.setdefault(batch,[]).append(record)
+            self.cond.notify_all()
+            return self.next_group
+
+    def has_pending(self,batch):
+        """True while records of the batch are queued or being written"""
+        with self.cond:
+            return batch in self.pending or batch in self.writing
+
+    def wait(self,ticket):
+        with self.cond:
+            while self.done_groups<=ticket:
+                self.cond.wait()
+            exc=self.failed.get(ticket) #every waiter of the group sees it
+        if exc is not None:
+            raise exc
+
+    def commit(self):
+        with self.commit_lock:
+            with self.cond:
+                pending,self.pending=self.pending,{}
+                self.writing=set(pending)
+                group=self.next_group
+                self.next_group+=1
+            exc=None
+            for batch,records in pending.items():
+                try:
+                    batch.journal.append(records)
+                    self.journaled.add(batch)
+                except Exception as e:
+                    print("Journal write failed for",batch.batchfile,e,file=sys.stderr)
+                    exc=e
+            with self.cond:
+                self.writing=set()
+                if exc is not None:
+                    self.failed[group]=exc
+                self.done_groups=group+1
+                self.cond.notify_all()
+
+    def compact(self):
+        with self.commit_lock:
+            for batch in list(self.journaled):
+                try:
+                    batch.compact()
+                    self.journaled.discard(batch)
+                except Exception as e:
+                    print("Compaction failed for",batch.batchfile,e,file=sys.stderr)
+            self.last_compaction=time.time()
+
+    def flush(self):
+        """Commit everything pending and compact all journals, used at shutdown"""
+        self.commit()
+        self.compact()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending and time.time()-self.last_compaction<self.compact_interval:
+                    self.cond.wait(timeout=self.commit_interval)
+            time.sleep(self.commit_interval) #let the group fill up
+            self.commit()
+            if time.time()-self.last_compaction>=self.compact_interval:
+                self.compact()
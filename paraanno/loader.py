@@ -0,0 +1,87 @@
+import functools
+import hashlib
+import json
+import os
+import pickle
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+# Batch parsing for startup, kept free of app state so worker processes can import it
+
+
+def file_stat(fname):
+    st=os.stat(fname)
+    return [st.st_mtime_ns,st.st_size]
+
+def snapshot_entry(snapshot,fname,stat):
+    """Path of the pickled pair list of fname at this file stat in the snapshot directory"""
+    key=hashlib.sha1(fname.encode("utf-8")).hexdigest()
+    return os.path.join(snapshot,f"{key}-{stat[0]}-{stat[1]}.pickle")
+
+def parse_batch_file(fname,snapshot=None):
+    """(stat, pickled pair list), the stat is taken before reading so a concurrent write shows up as a mismatch later.
+    With a snapshot directory the pickle is also written there as the entry of this file."""
+    stat=file_stat(fname)
+    with open(fname) as f:
+        data=json.load(f)
+    blob=pickle.dumps(data,protocol=pickle.HIGHEST_PROTOCOL)
+    if snapshot:
+        write_snapshot_entry(snapshot_entry(snapshot,fname,stat),blob)
+    return stat,blob
+
+def read_snapshot_entry(entry):
+    try:
+        with open(entry,"rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError,pickle.UnpicklingError,EOFError) as e:
+        print("Ignoring unreadable snapshot entry",entry,e,file=sys.stderr)
+        return None
+
+def write_snapshot_entry(entry,blob):
+    tmp=entry+".tmp"
+    with open(tmp,"wb") as f:
+        f.write(blob)
+    os.replace(tmp,entry)
+
+def parse_batches(fnames,workers=1,snapshot=None):
+    """path -> (stat, pair list) for all fnames.
+    snapshot: directory of pickled batches from the previous start, one entry per file and stat. Files whose entry is there skip json parsing,
+    the others are parsed and get a new entry, and entries of changed or missing files are removed.
+    workers: parse the remaining files in this many processes."""
+    stale=set()
+    if snapshot:
+        os.makedirs(snapshot,exist_ok=True)
+        stale={name for name in os.listdir(snapshot) if name.endswith((".pickle",".tmp"))}
+    parsed={}
+    todo=[]
+    for fname in fnames:
+        stat=file_stat(fname)
+        data=read_snapshot_entry(snapshot_entry(snapshot,fname,stat)) if snapshot else None
+        if data is None:
+            todo.append(fname)
+            continue
+        parsed[fname]=(stat,data)
+        stale.discard(os.path.basename(snapshot_entry(snapshot,fname,stat)))
+    parse=functools.partial(parse_batch_file,snapshot=snapshot)
+    if workers>1 and len(todo)>1:
+        with ProcessPoolExecutor(workers) as pool:
+            parsed.update(load_blobs(snapshot,stale,zip(todo,pool.map(parse,todo,chunksize=4))))
+    else:
+        parsed.update(load_blobs(snapshot,stale,((fname,parse(fname)) for fname in todo)))
+    for name in stale:
+        try:
+            os.remove(os.path.join(snapshot,name))
+        except OSError:
+            pass
+    return parsed
+
+def load_blobs(snapshot,stale,results):
+    # unpickle one parsed file at a time, its blob is dropped before the next one is read
+    for fname,(stat,blob) in results:
+        if snapshot:
+            stale.discard(os.path.basename(snapshot_entry(snapshot,fname,stat)))
+        data=pickle.loads(blob)
+        del blob
+        yield fname,(stat,data)
@@ -0,0 +1,146 @@
+import threading
+import bisect
+
+# Counters, gauges and histograms served on /metrics in the Prometheus text format.
+# Recording is a dict update under a lock, cheap enough to leave on whether or not anyone scrapes.
+
+REGISTRY=[]
+
+def escape(value):
+    return str(value).replace("\\","\\\\").replace("\"","\\\"").replace("\n","\\n")
+
+def format_labels(names,values,extra=()):
+    pairs=list(zip(names,values))+list(extra)
+    if not pairs:
+        return ""
+    return "{"+",".join(f'{name}="{escape(value)}"' for name,value in pairs)+"}"
+
+def format_value(value):
+    if value==float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value,float) else str(value)
+
+
+class Metric:
+
+    kind="untyped"
+
+    def __init__(self,name,doc,labels=()):
+        self.name=name
+        self.doc=doc
+        self.labels=tuple(labels)
+        self.lock=threading.Lock()
+        self.values={} #label values -> value
+        REGISTRY.append(self)
+
+    def key(self,labels):
+        if set(labels)!=set(self.labels):
+            raise ValueError(f"{self.name} takes labels {', '.join(self.labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self):
+        """[(name suffix, label values, extra labels, value)]"""
+        with self.lock:
+            return [("",key,(),value) for key,value in sorted(self.values.items())]
+
+    def render(self):
+        lines=[f"# HELP {self.name} {self.doc}",f"# TYPE {self.name} {self.kind}"]
+        for suffix,key,extra,value in self.samples():
+            lines.append(f"{self.name}{suffix}{format_labels(self.labels,key,extra)} {format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """Only goes up. With func, the value is read from func() at scrape time (e.g. a counter some other object keeps)"""
+
+    kind="counter"
+
+    def __init__(self,name,doc,labels=(),func=None):
+        super().__init__(name,doc,labels)
+        self.func=func
+        if not self.labels:
+            self.values[()]=0 #shows up as 0 before the first inc()
+
+    def inc(self,amount=1,**labels):
+        key=self.key(labels)
+        with self.lock:
+            self.values[key]=self.values.get(key,0)+amount
+
+    def samples(self):
+        if self.func is not None:
+            return [("",(),(),self.func())]
+        return super().samples()
+
+
+class Gauge(Metric):
+    """Current value of something, read from func() at scrape time. func returns a number, or {label values: number} if the gauge has labels"""
+
+    kind="gauge"
+
+    def __init__(self,name,doc,func,labels=()):
+        super().__init__(name,doc,labels)
+        self.func=func
+
+    def samples(self):
+        value=self.func()
+        if value is None:
+            return []
+        if not self.labels:
+            return [("",(),(),value)]
+        return [("",tuple(map(str,key)),(),v) for key,v in sorted(value.items())]
+
+
+class Histogram(Metric):
+
+    kind="histogram"
+    BUCKETS=(0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10)
+
+    def __init__(self,name,doc,labels=(),buckets=BUCKETS):
+        super().__init__(name,doc,labels)
+        self.buckets=tuple(buckets)
+
+    def observe(self,value,**labels):
+        key=self.key(labels)
+        i=bisect.bisect_left(self.buckets,value)
+        with self.lock:
+            counts=self.values.get(key)
+            if counts is None:
+                counts=self.values[key]=[[0]*(len(self.buckets)+1),0.0] #per-bucket counts, last one is +Inf; sum
+            counts[0][i]+=1
+            counts[1]+=value
+
+    def samples(self):
+        result=[]
+        with self.lock:
+            for key,(counts,total) in sorted(self.values.items()):
+                cumulative=0
+                for bound,count in zip(self.buckets+(float("inf"),),counts):
+                    cumulative+=count
+                    result.append(("_bucket",key,(("le",format_value(float(bound))),),cumulative))
+                result.append(("_sum",key,(),total))
+                result.append(("_count",key,(),cumulative))
+        return result
+
+
+def render():
+    return "\n".join(metric.render() for metric in REGISTRY)+"\n"
+
+def process_rss():
+    """Resident memory of this process in bytes, None where /proc is not there"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    return None
+
+
+# recorded by the storage code, registered here so they exist even before anything happens
+batch_writes=Counter("paraanno_batch_writes_total","Batch files rewritten (json save or journal compaction)")
+batch_write_bytes=Counter("paraanno_batch_write_bytes_total","Bytes of batch files written")
+batch_write_seconds=Histogram("paraanno_batch_write_seconds","Time spent in Batch.save(), by phase",labels=("phase",))
+journal_records=Counter("paraanno_journal_records_total","Annotation records appended to journals")
+journal_bytes=Counter("paraanno_journal_bytes_total","Bytes appended to journals")
+journal_fsyncs=Counter("paraanno_journal_fsyncs_total","Journal fsyncs, one per batch per commit group")
@@ -0,0 +1,53 @@
+import hashlib
+from .iaa import normalize_label, iso_week
+
+# What the app knows about a pair and its annotation, shared by the storage backends
+
+EDITABLE_FIELDS={"label","rew1","rew2","txt1inp","txt2inp","flagged","flagcomment","user"} #what a delta save may touch
+
+def pair_status(pair):
+    label=(pair.get("annotation") or {}).get("label")
+    if label is None:
+        return "left"
+    if label=="x":
+        return "skipped"
+    if "|" in label or label.strip()=="": # label not completed
+        return "left"
+    return "completed"
+
+def flag_entry(pair):
+    """(updated, label, txt1 start, txt2 start) of a flagged pair, None if not flagged"""
+    ann=pair.get("annotation") or {}
+    if ann.get("flagged", "false")!="true":
+        return None
+    return (ann.get("updated","not updated"),ann.get("label","?"),pair["txt1"][:50],pair["txt2"][:50])
+
+def agreement_entry(pair):
+    """(normalized label, ISO week, text fingerprint) of a pair that counts for agreement, None if it does not (no label, skipped or not finished)"""
+    ann=pair.get("annotation") or {}
+    label=ann.get("label")
+    if not label or label.lower()=="x" or "|" in label: #as agreement.py
+        return None
+    label=normalize_label(label)
+    if not label:
+        return None
+    texts=(pair["txt1"]+"\n"+pair["txt2"]).encode("utf-8")
+    return (label,iso_week(ann.get("updated","unknown")),hashlib.sha1(texts).hexdigest()[:16])
+
+def client_pair(idx,pair):
+    """What the annotation page shows of a pair, the pair api sends these"""
+    return {"pairseq":idx,
+            "txt1":pair["txt1"],
+            "txt2":pair["txt2"],
+            "name":pair.get("meta", {}).get("name", "").replace("\\", "").strip(),
+            "annotation":pair.get("annotation") or {}}
+
+class BatchDetached(Exception):
+    """The batch was replaced or dropped by a rescan while the write waited for it, look it up again"""
+
+class StaleWrite(Exception):
+    """The client edited an older version of the annotation than the one stored"""
+
+    def __init__(self,annotation):
+        super().__init__("stale write")
+        self.annotation=annotation
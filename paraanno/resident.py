@@ -0,0 +1,51 @@
+import collections
+import threading
+
+
+class ResidentSet:
+    """LRU of batches whose pair data is in memory. Evicts by count and, if max_bytes is set, by batch file size as a memory proxy."""
+
+    def __init__(self,max_count=50,max_bytes=None):
+        self.max_count=max_count
+        self.max_bytes=max_bytes
+        self.lock=threading.Lock()
+        self.batches=collections.OrderedDict() #batch -> size in bytes, least recently used first
+        self.bytes=0
+
+    def __len__(self):
+        return len(self.batches)
+
+    def touch(self,batch):
+        with self.lock:
+            if batch in self.batches:
+                self.batches.move_to_end(batch)
+                return
+            size=batch.size()
+            self.batches[batch]=size
+            self.bytes+=size
+            victims=[b for b in self.batches if b is not batch] #oldest first
+        for victim in victims:
+            if not self.over_budget():
+                break
+            #never block here: the caller may hold its own batch lock and the victim's owner may be waiting for ours
+            if not victim.lock.acquire(blocking=False):
+                continue
+            try:
+                if victim.is_dirty(): #edits still on their way to the journal or the batch file, they must not be reloaded from disk
+                    continue
+                victim.unload()
+                self.forget(victim)
+            finally:
+                victim.lock.release()
+
+    def forget(self,batch):
+        with self.lock:
+            size=self.batches.pop(batch,None)
+            if size is not None:
+                self.bytes-=size
+
+    def over_budget(self):
+        with self.lock:
+            if len(self.batches)>self.max_count:
+                return True
+            return self.max_bytes is not None and self.bytes>self.max_bytes and len(self.batches)>1
@@ -0,0 +1,302 @@
+import sqlite3
+import json
+import os
+import datetime
+import threading
+import contextlib
+from collections import Counter
+from collections.abc import Mapping
+from .pairs import StaleWrite, pair_status, flag_entry, agreement_entry
+from .align import read_precomputed
+from . import metrics
+
+# Batches in one SQLite database (WAL mode) so several worker processes can serve the same data.
+# SqliteStore behaves like the user -> batchfile -> Batch dict of the json storage.
+
+SCHEMA="""
+CREATE TABLE IF NOT EXISTS batches(
+    user TEXT NOT NULL,
+    fname TEXT NOT NULL,
+    length INTEGER NOT NULL,
+    n_completed INTEGER NOT NULL,
+    n_skipped INTEGER NOT NULL,
+    n_left INTEGER NOT NULL,
+    last_update TEXT,
+    PRIMARY KEY(user,fname));
+CREATE TABLE IF NOT EXISTS pairs(
+    user TEXT NOT NULL,
+    fname TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    pair TEXT NOT NULL, -- the pair as json, without its annotation
+    annotation TEXT, -- json, NULL if the pair has no annotation key
+    status TEXT NOT NULL, -- pair_status()
+    flagged INTEGER NOT NULL,
+    updated TEXT,
+    version INTEGER NOT NULL,
+    PRIMARY KEY(user,fname,idx));
+CREATE INDEX IF NOT EXISTS pairs_flagged ON pairs(user,updated) WHERE flagged=1;
+CREATE INDEX IF NOT EXISTS pairs_updated ON pairs(user,fname,updated);
+CREATE INDEX IF NOT EXISTS pairs_completed ON pairs(fname,idx,user) WHERE status='completed';
+"""
+
+sqlite_annotation_bytes=metrics.Counter("paraanno_sqlite_annotation_bytes_total","Bytes of annotation json written to the database")
+
+
+def pair_columns(pair):
+    ann=pair.get("annotation")
+    ann_dict=ann if isinstance(ann,dict) else {}
+    return (pair_status(pair),int(flag_entry(pair) is not None),ann_dict.get("updated"),ann_dict.get("version",0))
+
+def later(a,b):
+    #max of two iso timestamps, either may be None
+    if a is None or b is None:
+        return a or b
+    return max(a,b,key=datetime.datetime.fromisoformat)
+
+
+class SqliteStore(Mapping):
+
+    def __init__(self,fname,datadir=None):
+        self.fname=fname
+        self.datadir=datadir #where <batchfile>.align files of precompute_alignments.py are looked up
+        self.local=threading.local()
+        self.precomputed={} #path -> (mtime, blocks)
+        self.lock=threading.Lock()
+        self.db().executescript(SCHEMA)
+
+    def db(self):
+        #one connection per thread, autocommit unless we BEGIN
+        db=getattr(self.local,"db",None)
+        if db is None:
+            db=sqlite3.connect(self.fname,isolation_level=None,timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db=db
+        return db
+
+    @contextlib.contextmanager
+    def transaction(self):
+        db=self.db()
+        db.execute("BEGIN IMMEDIATE") #take the write lock up front, no upgrade deadlocks between workers
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def __getitem__(self,user):
+        if self.db().execute("SELECT 1 FROM batches WHERE user=? LIMIT 1",(user,)).fetchone() is None:
+            raise KeyError(user)
+        return SqliteUserBatches(self,user)
+
+    def __iter__(self):
+        return iter([row[0] for row in self.db().execute("SELECT DISTINCT user FROM batches ORDER BY user")])
+
+    def __len__(self):
+        return self.db().execute("SELECT COUNT(DISTINCT user) FROM batches").fetchone()[0]
+
+    def user_stats(self,user):
+        row=self.db().execute("SELECT COUNT(*),SUM(n_completed+n_skipped=length),SUM(n_completed),SUM(n_skipped),SUM(n_left),SUM(length) FROM batches WHERE user=?",(user,)).fetchone()
+        return Counter(dict(zip(("batches","completed_batches","completed","skipped","left","total"),(x or 0 for x in row))))
+
+    def flags(self,user=None):
+        """[(user, batchfile, pair index, flag_entry())], served from the partial index on flagged pairs"""
+        query="SELECT user,fname,idx,pair,annotation FROM pairs WHERE flagged=1"
+        args=()
+        if user is not None:
+            query+=" AND user=?"
+            args=(user,)
+        result=[]
+        for u,fname,idx,pair,ann in self.db().execute(query,args):
+            pair=json.loads(pair)
+            pair["annotation"]=json.loads(ann)
+            result.append((u,fname,idx,flag_entry(pair)))
+        return result
+
+    def agreement(self):
+        """Pairwise label confusions like LiveAgreement.snapshot(), a self-join over the partial index on completed pairs with the same texts.
+        Counted per request, the database is shared with other workers so there is nothing to keep incrementally."""
+        query="""SELECT a.fname,json_extract(a.pair,'$.txt1'),json_extract(a.pair,'$.txt2'),a.user,a.annotation,b.user,b.annotation FROM pairs a JOIN pairs b
+                 ON b.fname=a.fname AND b.idx=a.idx AND b.user>a.user AND b.status='completed'
+                 WHERE a.status='completed' AND json_extract(b.pair,'$.txt1')=json_extract(a.pair,'$.txt1') AND json_extract(b.pair,'$.txt2')=json_extract(a.pair,'$.txt2')"""
+        confusions={}
+        for fname,txt1,txt2,user1,ann1,user2,ann2 in self.db().execute(query):
+            entry1,entry2=(agreement_entry({"txt1":txt1,"txt2":txt2,"annotation":json.loads(ann)}) for ann in (ann1,ann2))
+            if entry1 is None or entry2 is None: #e.g. X, completed but not counted
+                continue
+            scopes=[("batch",fname)]
+            if entry1[1]==entry2[1]:
+                scopes.append(("week",entry1[1]))
+            for scope in scopes:
+                confusions.setdefault(scope,{}).setdefault((user1,user2),Counter())[(entry1[0],entry2[0])]+=1
+        return confusions
+
+    def import_batch(self,user,fname,data,replace=False):
+        """Store a batch (list of pairs as in the json files), returns False if it exists and replace is not set"""
+        with self.transaction() as db:
+            if db.execute("SELECT 1 FROM batches WHERE user=? AND fname=?",(user,fname)).fetchone() is not None:
+                if not replace:
+                    return False
+                db.execute("DELETE FROM batches WHERE user=? AND fname=?",(user,fname))
+                db.execute("DELETE FROM pairs WHERE user=? AND fname=?",(user,fname))
+            stats=Counter()
+            last_update=None
+            rows=[]
+            for idx,pair in enumerate(data):
+                pair=dict(pair)
+                cols=pair_columns(pair)
+                stats[cols[0]]+=1
+                last_update=later(last_update,cols[2])
+                ann=json.dumps(pair.pop("annotation"),ensure_ascii=False) if "annotation" in pair else None
+                rows.append((user,fname,idx,json.dumps(pair,ensure_ascii=False),ann)+cols)
+            db.executemany("INSERT INTO pairs(user,fname,idx,pair,annotation,status,flagged,updated,version) VALUES (?,?,?,?,?,?,?,?,?)",rows)
+            db.execute("INSERT INTO batches VALUES (?,?,?,?,?,?,?)",(user,fname,len(data),stats["completed"],stats["skipped"],stats["left"],last_update))
+        return True
+
+    def export_batch(self,user,fname):
+        """The batch as a list of pairs, exactly what import_batch() got"""
+        data=[]
+        for pair,ann in self.db().execute("SELECT pair,annotation FROM pairs WHERE user=? AND fname=? ORDER BY idx",(user,fname)):
+            pair=json.loads(pair)
+            if ann is not None:
+                pair["annotation"]=json.loads(ann)
+            data.append(pair)
+        return data
+
+    def precomputed_blocks(self,user,fname):
+        if self.datadir is None:
+            return {}
+        path=os.path.join(self.datadir,f"batches-{user}",fname+".align")
+        mtime=os.path.getmtime(path) if os.path.exists(path) else None
+        with self.lock:
+            if path not in self.precomputed or self.precomputed[path][0]!=mtime:
+                self.precomputed[path]=(mtime,read_precomputed(path))
+            return self.precomputed[path][1]
+
+
+class SqliteUserBatches(Mapping):
+    """batchfile -> SqliteBatch of one user"""
+
+    def __init__(self,store,user):
+        self.store=store
+        self.user=user
+
+    def _rows(self,fname=None):
+        query="SELECT fname,length,n_completed,n_skipped,n_left,last_update FROM batches WHERE user=?"
+        args=(self.user,)
+        if fname is not None:
+            query+=" AND fname=?"
+            args+=(fname,)
+        return self.store.db().execute(query+" ORDER BY fname",args).fetchall()
+
+    def __getitem__(self,fname):
+        rows=self._rows(fname)
+        if not rows:
+            raise KeyError(fname)
+        return SqliteBatch(self.store,self.user,rows[0])
+
+    def __iter__(self):
+        return iter([row[0] for row in self._rows()])
+
+    def __len__(self):
+        return len(self._rows())
+
+    def items(self):
+        #one query instead of one per batch
+        return [(row[0],SqliteBatch(self.store,self.user,row)) for row in self._rows()]
+
+    def values(self):
+        return [batch for _,batch in self.items()]
+
+
+class SqliteBatch:
+    """Same interface as app.Batch; the counters are a snapshot taken when the batch was looked up"""
+
+    def __init__(self,store,user,row):
+        self.store=store
+        self.user=user
+        self.fname,self.length,completed,skipped,left,self.last_update=row
+        self.stats=Counter(completed=completed,skipped=skipped,left=left)
+
+    @property
+    def data(self):
+        return self.store.export_batch(self.user,self.fname)
+
+    def pair(self,pairseq):
+        row=self.store.db().execute("SELECT pair,annotation FROM pairs WHERE user=? AND fname=? AND idx=?",(self.user,self.fname,pairseq)).fetchone()
+        if row is None:
+            raise IndexError(pairseq)
+        pair=json.loads(row[0])
+        if row[1] is not None:
+            pair["annotation"]=json.loads(row[1])
+        return pair
+
+    def pairs(self,offset=0,limit=None):
+        """[(pair index, pair)] of a slice of the batch"""
+        result=[]
+        for idx,pair,ann in self.store.db().execute("SELECT idx,pair,annotation FROM pairs WHERE user=? AND fname=? ORDER BY idx LIMIT ? OFFSET ?",(self.user,self.fname,-1 if limit is None else limit,offset)):
+            pair=json.loads(pair)
+            if ann is not None:
+                pair["annotation"]=json.loads(ann)
+            result.append((idx,pair))
+        return result
+
+    def precomputed_blocks(self):
+        return self.store.precomputed_blocks(self.user,self.fname)
+
+    def set_annotation(self,pairseq,annotation):
+        with self.store.transaction() as db:
+            ann,status=self._current(db,pairseq)
+            annotation["version"]=(ann or {}).get("version",0)+1
+            self._write(db,pairseq,status,annotation)
+
+    def update_annotation(self,pairseq,fields,version):
+        """Apply changed fields only. version is the one the client started from, raises StaleWrite if someone saved in between. Returns the new version."""
+        with self.store.transaction() as db:
+            ann,status=self._current(db,pairseq)
+            ann=ann or {}
+            if ann.get("version",0)!=version:
+                raise StaleWrite(ann)
+            ann.update(fields,version=version+1)
+            self._write(db,pairseq,status,ann)
+        return version+1
+
+    def _current(self,db,pairseq):
+        row=db.execute("SELECT annotation,status FROM pairs WHERE user=? AND fname=? AND idx=?",(self.user,self.fname,pairseq)).fetchone()
+        if row is None:
+            raise IndexError(pairseq)
+        return (json.loads(row[0]) if row[0] is not None else None),row[1]
+
+    def _write(self,db,pairseq,old_status,annotation):
+        pair=json.loads(db.execute("SELECT pair FROM pairs WHERE user=? AND fname=? AND idx=?",(self.user,self.fname,pairseq)).fetchone()[0])
+        pair["annotation"]=annotation
+        status,flagged,updated,version=pair_columns(pair)
+        ann=json.dumps(annotation,ensure_ascii=False)
+        db.execute("UPDATE pairs SET annotation=?,status=?,flagged=?,updated=?,version=? WHERE user=? AND fname=? AND idx=?",
+                   (ann,status,flagged,updated,version,self.user,self.fname,pairseq))
+        sqlite_annotation_bytes.inc(len(ann.encode("utf-8")))
+        last_update=db.execute("SELECT last_update FROM batches WHERE user=? AND fname=?",(self.user,self.fname)).fetchone()[0]
+        counts=Counter({old_status:-1})
+        counts[status]+=1
+        db.execute("UPDATE batches SET n_completed=n_completed+?,n_skipped=n_skipped+?,n_left=n_left+?,last_update=? WHERE user=? AND fname=?",
+                   (counts["completed"],counts["skipped"],counts["left"],later(last_update,updated),self.user,self.fname))
+
+    @property
+    def is_completed(self):
+        return self.stats["completed"]+self.stats["skipped"]==self.length
+
+    @property
+    def get_batch_len(self):
+        return self.length
+
+    @property
+    def get_anno_stats(self):
+        return (self.stats["completed"], self.stats["skipped"], self.stats["left"])
+
+    @property
+    def get_update_timestamp(self):
+        if self.last_update is None:
+            return "no updates"
+        else:
+            return datetime.datetime.fromisoformat(self.last_update).isoformat()
@@ -4,8 +4,10 @@ import argparse
 import glob
 import os
 import json
-from collections import Counter
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import sqlitedict
+from paraanno.contextstore import ContextStore
 
 
 
@@ -20,7 +22,8 @@ def calculate_idx(text):
         idx = hashlib.sha224(text.encode()).hexdigest()
         return idx
 
-def yield_segments(fname):
+def yield_segments(fname, counts=None):
+    # counts: Counter to count the locked and the not annotated segments in
 
     with open(fname, "rt", encoding="utf-8") as f:
         data = json.load(f)
@@ -35,20 +38,75 @@ def yield_segments(fname):
         annotation = segment.get("annotation", None)
         if segment.get("locked", False) == True:
             print(f'Segment {i} locked, annotator {segment.get("annotator")}, skipping')
+            if counts is not None:
+                counts["locked"] += 1
             continue
         if "annotation" in segment: # if segment not annotated, skip
                     
                 yield i, movie_meta, segment
+        elif counts is not None:
+                counts["not annotated"] += 1
         
-def get_document_text(db_name, table, doc_id):
-
-        db = sqlitedict.SqliteDict(db_name, tablename=table, flag="r")
-        
-        text = db.get(doc_id, "")
-        
-        db.close()
-
-        return text
+class TextStore:
+        """Documents of the text database (--text-db), read-only. One SqliteDict per table is kept open and
+        the most recently used documents are cached, the same documents come up in many segments."""
+
+        CHUNK = 500 # keys per query, below SQLite's limit on query parameters
+
+        def __init__(self, db_name, cache_size=256):
+                self.db_name = db_name
+                self.cache_size = cache_size
+                self.tables = {} # table -> SqliteDict
+                self.cache = OrderedDict() # (table, doc_id) -> text, least recently used first
+
+        def table(self, name):
+                db = self.tables.get(name)
+                if db is None:
+                        db = self.tables[name] = sqlitedict.SqliteDict(self.db_name, tablename=name, flag="r")
+                return db
+
+        def _remember(self, key, text):
+                self.cache[key] = text
+                self.cache.move_to_end(key)
+                if len(self.cache) > self.cache_size:
+                        self.cache.popitem(last=False)
+
+        def fetch(self, keys):
+                """(table, doc_id) -> text for all keys, "" for documents not in the database.
+                Documents not in the cache are read with one query per table (per CHUNK keys)."""
+                texts = {}
+                missing = {} # table -> [doc_id]
+                for key in keys:
+                        if key in texts:
+                                continue
+                        if key in self.cache:
+                                self.cache.move_to_end(key)
+                                texts[key] = self.cache[key]
+                        else:
+                                texts[key] = ""
+                                missing.setdefault(key[0], []).append(key[1])
+                for name, doc_ids in missing.items():
+                        db = self.table(name)
+                        for i in range(0, len(doc_ids), self.CHUNK):
+                                chunk = doc_ids[i:i+self.CHUNK]
+                                query = 'SELECT key, value FROM "%s" WHERE key IN (%s)' % (db.tablename, ",".join("?" * len(chunk)))
+                                for key, value in db.conn.select(query, tuple(db.encode_key(doc_id) for doc_id in chunk)):
+                                        texts[(name, db.decode_key(key))] = db.decode(value)
+                        for doc_id in doc_ids:
+                                self._remember((name, doc_id), texts[(name, doc_id)])
+                return texts
+
+        def get(self, table, doc_id):
+                return self.fetch([(table, doc_id)])[(table, doc_id)]
+
+        def close(self):
+                for db in self.tables.values():
+                        db.close()
+                self.tables = {}
+
+def segment_documents(segment):
+        # (table, doc_id) of the documents a segment needs from the text database, the ones it does not carry itself
+        return [tuple(segment.get(d)) for d in ("d1", "d2") if segment.get(d + "_text", "") == ""]
         
         
         
@@ -95,7 +153,8 @@ def yield_annotations(annotation, document_context1, document_context2):
                 yield d
         
 
-def transfer(args, segment, metadata):
+def transfer(args, segment, metadata, texts):
+        # texts: TextStore.fetch() result with segment_documents(segment) in it
                 
         table1, doc1 = segment.get("d1") # ["subtitle", "1955045028-001500.txt"]
         table2, doc2 = segment.get("d2")
@@ -104,9 +163,9 @@ def transfer(args, segment, metadata):
         doc2_text = segment.get("d2_text", "")
         
         if doc1_text == "":
-            doc1_text = get_document_text(args.text_db, table1, doc1)
+            doc1_text = texts[(table1, doc1)]
         if doc2_text == "":
-            doc2_text = get_document_text(args.text_db, table2, doc2)
+            doc2_text = texts[(table2, doc2)]
         
         annotation = segment.get("annotation")
         annotation = list(reversed(annotation)) # fix the order
@@ -124,11 +183,9 @@ def transfer(args, segment, metadata):
 
 
 
-def main(args):
-
-
-    annotated = read_annotated_files(args)
-
+def convert_file(args, file_name, annotated, text_store, store):
+    """Writes OUT_DIR/rew-batch-<name>-part-<segment>.json for the annotated segments of one pick batch.
+    Returns a Counter of what happened to the segments: generated, annotated (already), locked, not annotated, empty"""
 
 #    "meta": {
 #      "A-sim": 0.5622275607964768,
@@ -137,26 +194,71 @@ def main(args):
 #      "source_files": "/home/smp/data/news-paraphrase/hs-text/2019-02-19-11-15-15---aff63486a2d786a7006cd42c2b37eca1.txt /home/ginter/Similar-news/yle-text/2019-02-19-03-47-03--3-10652399.txt",
 #      "srcinfo": "14.9.2020 python3 gather_titles.py --paired paired_news.json --titles ~/yle_rss_downloader/titles_hs_yle.json --vectorizer vectorizer.pickle"
 
-    metadata = {"source_files": args.file_name, "srcinfo": "pick2para.py"}
+    counts = Counter()
+    metadata = {"source_files": file_name, "srcinfo": "pick2para.py"}
 
-    counter = 1
-    for idx, movie_meta, segment in yield_segments(args.file_name):
+    segments = list(yield_segments(file_name, counts))
+    texts = text_store.fetch([key for _, _, segment in segments for key in segment_documents(segment)]) # all documents of the file in one go
+
+    for idx, movie_meta, segment in segments:
         for key in movie_meta:
             metadata[key] = movie_meta[key]
-        rew_batch = transfer(args, segment, metadata) # list of examples in rew format
+        rew_batch = transfer(args, segment, metadata, texts) # list of examples in rew format
         if len(rew_batch)==0:
+                counts["empty"] += 1
                 continue
-        fname = os.path.basename(args.file_name).replace(".json", "")
+        fname = os.path.basename(file_name).replace(".json", "")
         fname = f"rew-batch-{fname}-part-{idx}.json"
         if fname in annotated:
                 print("Skipping already annotated file", fname, file=sys.stderr)
+                counts["annotated"] += 1
                 continue
+        if store is not None:
+            for example in rew_batch:
+                store.externalize(example)
         
         
-        with open(fname, "w", encoding="utf-8") as f:
+        out = os.path.join(args.out_dir, fname)
+        with open(out + ".tmp", "w", encoding="utf-8") as f: # .tmp and rename, an interrupted run leaves no half-written batch
                 print(f"Saving to", fname, file=sys.stderr)
                 print(json.dumps(rew_batch, sort_keys=True, indent=2, ensure_ascii=False), file=f)
-        counter += 1
+        os.replace(out + ".tmp", out)
+        counts["generated"] += 1
+    return counts
+
+
+worker = {} # what convert_in_worker() needs, set up once per process
+
+def init_worker(args, annotated):
+    worker["args"] = args
+    worker["annotated"] = annotated
+    worker["text_store"] = TextStore(args.text_db, args.cache_size)
+    worker["store"] = ContextStore(args.context_store) if args.context_store else None
+
+def convert_in_worker(file_name):
+    return file_name, convert_file(worker["args"], file_name, worker["annotated"], worker["text_store"], worker["store"])
+
+
+def main(args):
+
+
+    annotated = set(read_annotated_files(args)) # once, not per pick batch
+    files = sorted(glob.glob(os.path.join(args.input_dir, "*.json"))) if args.input_dir else [args.file_name]
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    if args.workers > 1 and len(files) > 1:
+        with ProcessPoolExecutor(args.workers, initializer=init_worker, initargs=(args, annotated)) as pool:
+            results = list(pool.map(convert_in_worker, files))
+    else:
+        init_worker(args, annotated)
+        results = [convert_in_worker(f) for f in files]
+        worker["text_store"].close()
+
+    totals = Counter()
+    for file_name, counts in results:
+        totals.update(counts)
+    print(f"{len(files)} pick batches, {sum(totals.values())} segments: {totals['generated']} batches generated, "
+          f"skipped {totals['locked']} locked, {totals['annotated']} already annotated, {totals['not annotated'] + totals['empty']} without annotations", file=sys.stderr)
     
 
 
@@ -166,10 +268,17 @@ if __name__=="__main__":
 
     argparser = argparse.ArgumentParser(description='')
     #argparser.add_argument('--data-dir', '-d', required=True, help='Top level directory of annotation batches (i.e. /path/to/data if data/batches-Annotator1/batch1.json)')
-    argparser.add_argument('--file-name', '-f', required=True, help='Batch file name (i.e. /path/to/data/batches-Annotator1/batch1.json)')
+    argparser.add_argument('--file-name', '-f', help='Batch file name (i.e. /path/to/data/batches-Annotator1/batch1.json)')
+    argparser.add_argument('--input-dir', '-i', help='Convert every pick batch in this directory instead of one --file-name (i.e. /path/to/data/batches-Annotator1)')
+    argparser.add_argument('--out-dir', '-o', default=".", help='Where to write the rew-batch-*.json files (default: current directory)')
+    argparser.add_argument('--workers', type=int, default=os.cpu_count(), help='With --input-dir, convert this many pick batches at a time in separate processes (default: number of CPUs)')
     argparser.add_argument('--text-db', required=True, help='Database name (i.e. /path/to/all-texts.sqlited)')
     argparser.add_argument('--annotated-batches', required=True, help='Top level directory of annotated batches. Do not create if already exists here. (i.e. /path/to/ann_data)')
+    argparser.add_argument('--cache-size', type=int, default=256, help='Documents of the text database kept in memory for reuse (default: 256)')
+    argparser.add_argument('--context-store', help='Write document contexts into this context store and keep only references in the examples (i.e. /path/to/ann_data/contexts)')
     args = argparser.parse_args()
+    if (args.file_name is None) == (args.input_dir is None):
+        argparser.error("give either --file-name or --input-dir")
 
     main(args)
     
@@ -180,5 +289,6 @@ if __name__=="__main__":
     # in /home/jmnybl/git_checkout/rew-para-anno/batches-pick2rew
     
     # cd batches-HannaMari ;  for f in /home/ginter/pick_ann_data_live_old/batches-HannaMari/*.json ; do echo $f ; python ../../pick2rew.py -f $f --text-db /home/ginter/pick_ann_data_live_new/all-texts.sqlited --annotated-batches /home/ginter/ann_data ; done
+    # or in one run: python pick2rew.py -i /home/ginter/pick_ann_data_live_old/batches-HannaMari -o batches-HannaMari --text-db /home/ginter/pick_ann_data_live_new/all-texts.sqlited --annotated-batches /home/ginter/ann_data
 
 
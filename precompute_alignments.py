@@ -0,0 +1,66 @@
+import sys
+import argparse
+import glob
+import os
+import json
+from multiprocessing import Pool
+from paraanno.contextstore import ContextStore
+from paraanno.align import ENGINES, AlignmentCache, normalize_context, write_precomputed
+
+
+def read_files(args):
+    if args.file_name:
+        return args.file_name
+    json_files = glob.glob(os.path.join(args.data_dir, "batches-*", "*.json"))
+    return sorted(json_files)
+
+def align_pair(job):
+    key, text1, text2, minlen, engine = job
+    return key, ENGINES[engine](text1, text2, minlen)
+
+def yield_jobs(data, store, minlen, engine):
+    seen = set()
+    for example in data:
+        text1 = normalize_context(store.resolve(example, 1))
+        text2 = normalize_context(store.resolve(example, 2))
+        if not text1 or not text2:
+            continue
+        key = AlignmentCache.key(text1, text2, minlen, engine) # same key the app looks up
+        if key in seen: # pairs from one segment share their documents
+            continue
+        seen.add(key)
+        yield key, text1, text2, minlen, engine
+
+
+def main(args):
+
+    store = ContextStore(args.context_store or os.path.join(args.data_dir or ".", "contexts"))
+    files = read_files(args)
+    with Pool(args.workers) as pool:
+        for fname in files:
+            with open(fname, "rt", encoding="utf-8") as f:
+                data = json.load(f)
+            jobs = list(yield_jobs(data, store, args.minlen, args.engine))
+            blocks = dict(pool.imap_unordered(align_pair, jobs))
+            write_precomputed(fname + ".align", blocks, args.minlen, args.engine)
+            print(f"{fname}: {len(blocks)} alignments", file=sys.stderr)
+
+
+
+if __name__=="__main__":
+
+    argparser = argparse.ArgumentParser(description='Compute the context view alignments of every pair and store them next to the batch (<batchfile>.align) so the app only renders them.')
+    argparser.add_argument('--data-dir', '-d', help='Top level directory of annotation batches, all batches-*/*.json are processed')
+    argparser.add_argument('--file-name', '-f', nargs="+", help='Batch files to process instead of the whole data dir')
+    argparser.add_argument('--context-store', help='Context store directory (default: DATA_DIR/contexts)')
+    argparser.add_argument('--engine', default="difflib", choices=sorted(ENGINES), help='Alignment engine, must match PARAANN_ALIGN_ENGINE of the app (default: difflib)')
+    argparser.add_argument('--minlen', type=int, default=15, help='Shortest match, must match the app (default: 15)')
+    argparser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of processes (default: all cores)')
+    args = argparser.parse_args()
+    if not args.data_dir and not args.file_name:
+        argparser.error("give --data-dir or --file-name")
+
+    main(args)
+
+    # Usage: python precompute_alignments.py -d /home/ginter/ann_data --workers 16
+    # or right after pick2rew.py: python precompute_alignments.py -f rew-batch-*.json --context-store /home/ginter/ann_data/contexts
@@ -5,6 +5,23 @@ export FLASK_ENV=development
 export FLASK_APP=paraanno.app
 export PARAANN_DATA=$HOME/rew-para-anno/dummy
 export PARAANN_APP_ROOT=/rew-para
+# export PARAANN_STORAGE=journal # append saves to <batchfile>.journal, compacted into the batch file in the background
+# export PARAANN_STORAGE=sqlite PARAANN_DB=$PARAANN_DATA/paraanno.sqlite # shared by several workers, fill with batchdb.py import
+# export PARAANN_JOURNAL_COMMIT_MS=20 # group commit window
+# export PARAANN_JOURNAL_COMPACT_SECONDS=300
+# export PARAANN_LAZY=1 # index batches at startup, load pairs on first access
+# export PARAANN_MAX_RESIDENT=50 # batches kept in memory in lazy mode
+# export PARAANN_MAX_RESIDENT_MB=500 # optional, counted in batch file sizes
+# export PARAANN_CONTEXTS=$PARAANN_DATA/contexts # shared document contexts
+# export PARAANN_ALIGN_CACHE=$PARAANN_DATA/alignment-cache.sqlite # context view spans, empty for memory only
+# export PARAANN_ALIGN_CACHE_SIZE=64 # spans kept in memory
+# export PARAANN_LOAD_WORKERS=8 # parse batch files in parallel at startup
+# export PARAANN_SNAPSHOT=1 # keep a pickled snapshot of parsed batches, unchanged files skip json parsing on restart
+# export PARAANN_PAGE_SIZE=500 # rows per page in the pair and flag listings
+# export PARAANN_RESCAN_SECONDS=30 # pick up new, removed and changed batch files without a restart
+# export PARAANN_ALIGN_ENGINE=suffix # near-linear context alignment, default difflib
+# export PARAANN_PREFETCH=5 # pairs the annotation page loads ahead to switch without a page load, 0 is off
+# export PARAANN_METRICS=1 # request latency histograms and storage counters on /metrics (Prometheus text format), one set per worker
 
 flask run --port 6666
 
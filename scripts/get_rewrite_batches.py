@@ -49,6 +49,8 @@ def get_examples(data):
         example.pop("annotation", None)
         for key in "document_context1, document_context2, anchor1, anchor2, focus1, focus2".split(", "):
             example[key] = ""
+        example.pop("document_context1_ref", None)
+        example.pop("document_context2_ref", None)
         
         if example.get("id", "").endswith("-rew"):
             rewrites.append(example)
@@ -0,0 +1,25 @@
+import os
+import sys
+import json
+import tempfile
+import pytest
+
+# paraanno.app reads its configuration at import time: an empty data dir and no alignment cache file for all tests,
+# the tests put their own batches into app.all_batches and the storage globals
+os.environ.setdefault("PARAANN_DATA", tempfile.mkdtemp(prefix="paraanno-test-"))
+os.environ["PARAANN_ALIGN_CACHE"] = ""
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PAIRS = [{"id": f"idx{i}", "txt1": f"Some text {2*i+1}", "txt2": f"Some text {2*i+2}"} for i in range(6)] # make_dummy.py
+
+
+@pytest.fixture
+def write_batch(tmp_path):
+    """write_batch(user, fname) -> path of a fresh make_dummy.py batch under tmp_path"""
+    def write(user, fname):
+        dirname = tmp_path / f"batches-{user}"
+        dirname.mkdir(exist_ok=True)
+        path = dirname / fname
+        path.write_text(json.dumps(PAIRS, indent=2, sort_keys=True))
+        return str(path)
+    return write
@@ -0,0 +1,61 @@
+import os
+import json
+import glob
+import pytest
+from paraanno import app
+from paraanno.iaa import LiveAgreement, agreement_report
+from paraanno.pairs import agreement_entry
+
+
+def from_scratch(datadir, relaxed):
+    # what the report should be, counted over the batch files as they are now
+    agreement = LiveAgreement()
+    for fname in sorted(glob.glob(os.path.join(datadir, "batches-*", "*.json"))):
+        dirname, basename = fname.split("/")[-2:]
+        with open(fname) as f:
+            data = json.load(f)
+        entries = {idx: entry for idx, entry in enumerate(map(agreement_entry, data)) if entry is not None}
+        agreement.add_batch(dirname.replace("batches-", ""), basename, entries)
+    return json.loads(json.dumps(agreement_report(agreement.snapshot(), relaxed)))
+
+@pytest.mark.parametrize("relaxed", [False, True])
+def test_live_agreement_matches_a_recount(write_batch, tmp_path, monkeypatch, relaxed):
+    for user in "ABC":
+        write_batch(user, "b1.json")
+    write_batch("A", "b2.json")
+    write_batch("B", "b2.json")
+    monkeypatch.setattr(app, "DATADIR", str(tmp_path))
+    monkeypatch.setattr(app, "journal_writer", None)
+    monkeypatch.setattr(app, "resident", None)
+    monkeypatch.setattr(app, "user_stats", {})
+    monkeypatch.setattr(app, "flag_index", {})
+    monkeypatch.setattr(app, "live_agreement", app.LiveAgreement())
+    monkeypatch.setattr(app, "all_batches", app.read_batches())
+    batches = app.all_batches
+
+    def label(user, fname, idx, label, updated="2024-03-05T10:00:00"):
+        batches[user][fname].set_annotation(idx, {"label": label, "updated": updated})
+
+    for idx, (a, b, c) in enumerate([("4", "4", "3"), ("4>", "4", "4<"), ("3", "2", "3"), ("x", "4", "4"), ("4|", "4", "1"), ("2", "2", "2")]):
+        label("A", "b1.json", idx, a)
+        label("B", "b1.json", idx, b, "2024-03-12T10:00:00" if idx % 2 else "2024-03-05T10:00:00")
+        label("C", "b1.json", idx, c)
+    label("A", "b2.json", 0, "4")
+    label("B", "b2.json", 0, "3")
+    label("A", "b2.json", 1, "2")
+    batches["A"]["b1.json"].update_annotation(0, {"label": "3", "updated": "2024-03-06T10:00:00"}, 1) # 4 -> 3
+    batches["A"]["b1.json"].update_annotation(4, {"label": "4", "updated": "2024-03-06T10:00:00"}, 1) # finished
+    batches["B"]["b2.json"].update_annotation(0, {"label": "x", "updated": "2024-03-06T10:00:00"}, 1) # no longer counts
+    batches["A"]["b2.json"].update_annotation(1, {"label": "2"}, 1) # same label
+
+    c = app.app.test_client()
+    url = "/api/agreement" + ("?relaxed=1" if relaxed else "")
+    report = c.get(url).get_json()
+    assert report == from_scratch(str(tmp_path), relaxed)
+    assert [s["annotators"] for s in report["total"]] == [["A", "B"], ["A", "C"], ["B", "C"]]
+
+    os.remove(tmp_path / "batches-C" / "b1.json")
+    app.rescan()
+    report = c.get(url).get_json()
+    assert report == from_scratch(str(tmp_path), relaxed)
+    assert [s["annotators"] for s in report["total"]] == [["A", "B"]]
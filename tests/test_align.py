@@ -0,0 +1,66 @@
+import random
+import pytest
+from paraanno.align import matches, suffix_matches, context_spans, AlignmentCache
+
+
+def coverage(s, blocks, side):
+    """per position of s, the length of the longest block covering it, 0 if none"""
+    cover = [0] * len(s)
+    for block in blocks:
+        i, l = block[side], block[2]
+        for k in range(i, i + l):
+            cover[k] = max(cover[k], l)
+    return cover
+
+def brute_coverage(s, t, minlen):
+    """per position of s, the length of the longest substring of s covering it that also occurs in t (>= minlen)"""
+    cover = [0] * len(s)
+    for i in range(len(s)):
+        for j in range(i + minlen, len(s) + 1):
+            if s[i:j] in t:
+                for k in range(i, j):
+                    cover[k] = max(cover[k], j - i)
+    return cover
+
+def random_pair(seed):
+    rnd = random.Random(seed)
+    alphabet = "ab " if seed % 2 else "abcde "
+    s1 = "".join(rnd.choice(alphabet) for _ in range(rnd.randint(0, 40)))
+    s2 = "".join(rnd.choice(alphabet) for _ in range(rnd.randint(0, 40)))
+    if seed % 3 == 0: # share a chunk for sure
+        s2 = s2[:10] + s1[5:25] + s2[10:]
+    return s1, s2, rnd.randint(1, 6)
+
+EDGE_CASES = [("", "", 3), ("", "abcdef", 3), ("abcdef", "", 3), ("koira ja kissa", "koira ja kissa", 5), ("koira", "koira", 5),
+              ("aaaaaa", "bbbbbb", 1), ("abcdef", "ghijkl", 2), ("aaaaaaaa", "aaa", 2), ("abcabcabc", "cabcab", 3), ("short", "short", 10)]
+
+@pytest.mark.parametrize("s1,s2,minlen", EDGE_CASES + [random_pair(seed) for seed in range(200)])
+def test_suffix_matches(s1, s2, minlen):
+    blocks = suffix_matches(s1, s2, minlen)
+    for i1, i2, l in blocks:
+        assert l >= minlen and s1[i1:i1+l] == s2[i2:i2+l]
+    assert blocks == sorted(blocks, key=lambda match: (match[2], match[0]))
+    # every position gets the longest common substring it is in, so it covers at least what the difflib matcher covers
+    for side, (s, t) in enumerate(((s1, s2), (s2, s1))):
+        cover = coverage(s, blocks, side)
+        assert cover == brute_coverage(s, t, minlen)
+        assert all(c >= d for c, d in zip(cover, coverage(s, matches(s1, s2, minlen), side)))
+
+def test_identical_and_disjoint():
+    assert suffix_matches("koira ja kissa", "koira ja kissa", 5) == [(0, 0, 14)]
+    assert suffix_matches("abcdef", "ghijkl", 2) == []
+    assert suffix_matches("", "", 1) == []
+
+def test_precomputed_blocks_only_read_on_a_cache_miss():
+    text1, text2 = "the cat sat on the mat today", "a cat sat on the mat yesterday"
+    key = AlignmentCache.key(text1, text2, 5)
+    calls = []
+    def precomputed():
+        calls.append(1)
+        return {key: [(3, 1, 19)]}
+    cache = AlignmentCache()
+    value = context_spans(text1, text2, 5, cache, precomputed=precomputed)
+    assert calls == [1]
+    assert value != context_spans(text1, text2, 5) # the precomputed blocks were used, not a fresh alignment
+    assert context_spans(text1, text2, 5, cache, precomputed=precomputed) == value
+    assert calls == [1]
@@ -0,0 +1,10 @@
+from paraanno import app, assets
+
+
+def test_etag_changes_when_assets_are_vendored(tmp_path, monkeypatch):
+    monkeypatch.setattr(assets, "VENDOR_DIR", str(tmp_path))
+    before = app.page_etag("doc.html", "A", "b1.json", 0)
+    assert app.page_etag("doc.html", "A", "b1.json", 0) == before
+    (tmp_path / "jquery-3.4.1").mkdir()
+    (tmp_path / "jquery-3.4.1" / "jquery.min.js").write_text("")
+    assert app.page_etag("doc.html", "A", "b1.json", 0) != before
@@ -0,0 +1,73 @@
+import json
+import os
+import pytest
+from paraanno import app
+from paraanno.journal import Journal, GroupCommitWriter
+
+
+@pytest.fixture
+def writer(monkeypatch):
+    writer = GroupCommitWriter(commit_interval=0.01, compact_interval=3600)
+    writer.start()
+    monkeypatch.setattr(app, "journal_writer", writer)
+    monkeypatch.setattr(app, "resident", None)
+    return writer
+
+def on_disk(path):
+    with open(path) as f:
+        return json.load(f)
+
+def restart(path, monkeypatch):
+    # a new process: no writer, the batch is read from its file and journal
+    monkeypatch.setattr(app, "journal_writer", None)
+    return app.Batch(path)
+
+
+def test_replay_on_load(write_batch, monkeypatch):
+    path = write_batch("A", "b1.json")
+    monkeypatch.setattr(app, "journal_writer", None)
+    Journal(path).append([{"pair": 0, "annotation": {"label": "4", "version": 1}},
+                          {"pair": 0, "update": {"rew1": "x", "version": 2}},
+                          {"pair": 3, "annotation": {"label": "x", "version": 1}}])
+    batch = app.Batch(path)
+    assert batch.pair(0)["annotation"] == {"label": "4", "rew1": "x", "version": 2}
+    assert batch.stats["completed"] == 1 and batch.stats["skipped"] == 1
+    # replayed records are compacted right away
+    assert not os.path.exists(path + ".journal")
+    assert on_disk(path)[0]["annotation"]["rew1"] == "x"
+
+def test_torn_journal_tail_is_ignored(write_batch, monkeypatch):
+    path = write_batch("A", "b1.json")
+    monkeypatch.setattr(app, "journal_writer", None)
+    Journal(path).append([{"pair": 1, "annotation": {"label": "3", "version": 1}}])
+    with open(path + ".journal", "a") as f:
+        f.write('{"pair": 2, "annot')
+    batch = app.Batch(path)
+    assert batch.pair(1)["annotation"]["label"] == "3"
+    assert "annotation" not in batch.pair(2)
+
+def test_group_commit_survives_restart(write_batch, writer, monkeypatch):
+    path = write_batch("A", "b1.json")
+    batch = app.Batch(path)
+    batch.set_annotation(0, {"label": "4", "user": "A"})
+    assert batch.update_annotation(0, {"rew1": "new"}, 1) == 2
+    batch.set_annotation(5, {"label": "2"})
+    # acknowledged: in the journal, the batch file is not rewritten until compaction
+    assert "annotation" not in on_disk(path)[0]
+    with open(path + ".journal") as f:
+        assert len(f.readlines()) == 3
+    reloaded = restart(path, monkeypatch)
+    assert reloaded.pair(0)["annotation"] == {"label": "4", "user": "A", "rew1": "new", "version": 2}
+    assert reloaded.pair(5)["annotation"]["label"] == "2"
+
+def test_compaction_then_reload(write_batch, writer, monkeypatch):
+    path = write_batch("A", "b1.json")
+    batch = app.Batch(path)
+    batch.set_annotation(2, {"label": "4<", "flagged": "true"})
+    writer.compact()
+    assert not os.path.exists(path + ".journal") and batch.journal.records == 0
+    assert on_disk(path)[2]["annotation"]["label"] == "4<"
+    batch.update_annotation(2, {"label": "4>"}, 1) # journaled again after the compaction
+    reloaded = restart(path, monkeypatch)
+    assert reloaded.pair(2)["annotation"] == {"label": "4>", "flagged": "true", "version": 2}
+    assert reloaded.flags.keys() == {2}
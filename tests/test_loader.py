@@ -0,0 +1,44 @@
+import os
+import json
+import pytest
+from paraanno import loader
+
+
+def entries(snapshot):
+    return {name: os.stat(os.path.join(snapshot, name)).st_ino for name in os.listdir(snapshot)}
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_snapshot_has_an_entry_per_batch(write_batch, tmp_path, monkeypatch, workers):
+    paths = [write_batch(user, "b1.json") for user in "ABC"]
+    snapshot = str(tmp_path / "snapshot")
+    pairs = json.loads(open(paths[0]).read())
+    parsed = loader.parse_batches(paths, workers, snapshot)
+    assert {path: data for path, (stat, data) in parsed.items()} == {path: pairs for path in paths}
+    first = entries(snapshot)
+    assert len(first) == 3
+
+    monkeypatch.setattr(loader, "parse_batch_file", lambda *args, **kwargs: pytest.fail("parsed an unchanged file"))
+    assert loader.parse_batches(paths, workers, snapshot) == parsed
+    assert entries(snapshot) == first
+    monkeypatch.undo()
+
+    changed = json.loads(open(paths[1]).read())
+    changed[0]["annotation"] = {"label": "4"}
+    with open(paths[1], "w") as f:
+        json.dump(changed, f)
+    parsed = loader.parse_batches(paths[1:], workers, snapshot)
+    assert parsed[paths[1]][1] == changed and parsed[paths[2]][1] == pairs
+    second = entries(snapshot)
+    assert len(second) == 2 # A is not asked for any more, B's old entry is replaced
+    unchanged = os.path.basename(loader.snapshot_entry(snapshot, paths[2], loader.file_stat(paths[2])))
+    assert second[unchanged] == first[unchanged] # not rewritten
+
+def test_unreadable_entry_is_parsed_again(write_batch, tmp_path):
+    path = write_batch("A", "b1.json")
+    pairs = json.loads(open(path).read())
+    snapshot = str(tmp_path / "snapshot")
+    loader.parse_batches([path], 1, snapshot)
+    with open(loader.snapshot_entry(snapshot, path, loader.file_stat(path)), "wb") as f:
+        f.write(b"garbage")
+    assert loader.parse_batches([path], 1, snapshot)[path][1] == pairs
+    assert loader.parse_batches([path], 1, snapshot)[path][1] == pairs
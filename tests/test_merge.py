@@ -0,0 +1,59 @@
+import os
+import json
+import argparse
+import pytest
+import merge_annotations
+
+
+@pytest.fixture
+def annotated(write_batch, tmp_path):
+    """b1.json and b2.json labelled by A, B and C; annotate(user, fname, idx, label) relabels one pair"""
+    def annotate(user, fname, idx, label):
+        path = tmp_path / f"batches-{user}" / fname
+        data = json.loads(path.read_text())
+        data[idx]["annotation"] = {"label": label, "updated": "2024-03-05T10:00:00", "version": 1}
+        path.write_text(json.dumps(data, indent=2, sort_keys=True))
+        st = os.stat(path)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000)) # a new stat even on coarse mtimes
+    for user in "ABC":
+        for fname in ("b1.json", "b2.json"):
+            path = write_batch(user, fname)
+            data = json.loads(open(path).read())
+            for idx, pair in enumerate(data):
+                pair["annotation"] = {"label": "4" if user != "C" or idx else "3", "updated": "2024-03-05T10:00:00", "version": 1}
+            with open(path, "w") as f:
+                json.dump(data, f, indent=2, sort_keys=True)
+    return annotate
+
+def merge_all(tmp_path, capsys):
+    # the per batch lines: basename -> (examples, merged anew, status)
+    args = argparse.Namespace(data_dir=str(tmp_path), out_dir=str(tmp_path / "merged"), full=False, workers=1,
+                              min_annotators=2, resolve_consensus=False, keep_context_refs=False)
+    capsys.readouterr()
+    merge_annotations.merge_all(args)
+    lines = {}
+    for line in capsys.readouterr().err.splitlines():
+        if line.startswith("b") and ".json: " in line:
+            basename, rest = line.split(": ", 1)
+            files, examples, remerged, status = rest.split(", ")
+            lines[basename] = (int(examples.split()[0]), int(remerged.split()[0]), status)
+    return lines
+
+def test_rerun_merges_only_what_changed(annotated, tmp_path, capsys):
+    out = tmp_path / "merged"
+    assert merge_all(tmp_path, capsys) == {"b1.json": (6, 6, "written"), "b2.json": (6, 6, "written")}
+    first = {fname: (out / fname).read_text() for fname in ("b1.json", "b2.json")}
+    assert json.loads(first["b1.json"])[0]["annotation"]["label"] == "4|4|3"
+
+    assert merge_all(tmp_path, capsys) == {"b1.json": (6, 0, "unchanged"), "b2.json": (6, 0, "unchanged")}
+
+    annotated("B", "b2.json", 3, "2")
+    assert merge_all(tmp_path, capsys) == {"b1.json": (6, 0, "unchanged"), "b2.json": (6, 1, "written")}
+    assert (out / "b1.json").read_text() == first["b1.json"]
+    old, new = json.loads(first["b2.json"]), json.loads((out / "b2.json").read_text())
+    assert new[3]["annotation"]["label"] == "4|2|4"
+    assert new[:3] + new[4:] == old[:3] + old[4:] # the others keep their merged example and timestamp
+
+    annotated("A", "b1.json", 0, "4") # rewritten, same label
+    assert merge_all(tmp_path, capsys)["b1.json"] == (6, 0, "kept")
+    assert (out / "b1.json").read_text() == first["b1.json"]
@@ -0,0 +1,43 @@
+import pytest
+from paraanno import app
+
+
+@pytest.fixture
+def client(write_batch, monkeypatch):
+    batch = app.Batch(write_batch("A", "b1.json"))
+    monkeypatch.setattr(app, "all_batches", {"A": {"b1.json": batch}})
+    monkeypatch.setattr(app, "journal_writer", None)
+    monkeypatch.setattr(app, "resident", None)
+    return app.app.test_client(), batch
+
+
+@pytest.mark.parametrize("body", [
+    [1],
+    "label",
+    {"version": 0, "fields": ["label"]},
+    {"fields": {"label": "4"}},
+    {"version": True, "fields": {"label": "4"}},
+    {"version": "0", "fields": {"label": "4"}},
+    {"version": 0, "fields": {"label": 5}},
+    {"version": 0, "fields": {"flagged": None}},
+    {"version": 0, "fields": {"version": "7"}},
+])
+def test_bad_patch_is_400_and_changes_nothing(client, body):
+    c, batch = client
+    r = c.patch("/saveann/A/b1.json/0", json=body)
+    assert r.status_code == 400
+    assert "annotation" not in batch.pair(0) or batch.pair(0)["annotation"] == {}
+    assert batch.stats["left"] == 6
+    assert c.patch("/saveann/A/b1.json/0", json={"version": 0, "fields": {"label": "4"}}).get_json()["version"] == 1 # no conflict after it
+
+def test_patch_not_json_is_400(client):
+    c, _ = client
+    assert c.patch("/saveann/A/b1.json/0", data="{", content_type="application/json").status_code == 400
+
+def test_patch(client):
+    c, batch = client
+    r = c.patch("/saveann/A/b1.json/0", json={"version": 0, "fields": {"label": "4", "flagged": "false"}})
+    assert r.status_code == 200 and r.get_json()["version"] == 1
+    assert batch.pair(0)["annotation"]["label"] == "4"
+    assert batch.stats["completed"] == 1
+    assert c.patch("/saveann/A/b1.json/0", json={"version": 0, "fields": {"label": "3"}}).status_code == 409
@@ -0,0 +1,39 @@
+import json
+import threading
+import time
+from paraanno import app
+
+
+def test_write_waiting_through_a_rescan_goes_to_the_reloaded_batch(write_batch, tmp_path, monkeypatch):
+    path = write_batch("A", "b1.json")
+    monkeypatch.setattr(app, "DATADIR", str(tmp_path))
+    monkeypatch.setattr(app, "journal_writer", None)
+    monkeypatch.setattr(app, "resident", None)
+    monkeypatch.setattr(app, "user_stats", {})
+    monkeypatch.setattr(app, "flag_index", {})
+    monkeypatch.setattr(app, "live_agreement", app.LiveAgreement())
+    monkeypatch.setattr(app, "all_batches", app.read_batches())
+    old = app.all_batches["A"]["b1.json"]
+    c = app.app.test_client()
+
+    responses = []
+    with old.lock: # the request looks the batch up, then waits here
+        request = threading.Thread(target=lambda: responses.append(c.patch("/saveann/A/b1.json/0", json={"version": 0, "fields": {"label": "4"}})))
+        request.start()
+        time.sleep(0.2)
+        with open(path) as f:
+            data = json.load(f)
+        data[1]["annotation"] = {"label": "3", "version": 1, "flagged": "true"} # edited outside the app
+        with open(path, "w") as f:
+            json.dump(data, f)
+        app.rescan()
+    request.join()
+
+    assert responses[0].status_code == 200
+    new = app.all_batches["A"]["b1.json"]
+    assert new is not old and old.detached
+    with open(path) as f:
+        data = json.load(f)
+    assert data[0]["annotation"]["label"] == "4" and data[1]["annotation"]["label"] == "3" # neither write lost
+    assert app.user_stats["A"]["completed"] == 2 and app.user_stats["A"]["batches"] == 1
+    assert list(app.flag_index["A"]) == [("b1.json", 1)]
@@ -0,0 +1,28 @@
+import json
+import threading
+import time
+from paraanno import app
+from paraanno.journal import GroupCommitWriter
+from paraanno.resident import ResidentSet
+
+
+def test_no_eviction_while_group_commit_pending(write_batch, monkeypatch):
+    writer = GroupCommitWriter(commit_interval=0.5, compact_interval=3600)
+    writer.start()
+    monkeypatch.setattr(app, "journal_writer", writer)
+    monkeypatch.setattr(app, "resident", ResidentSet(max_count=1))
+    b1, b2 = app.Batch(write_batch("A", "b1.json")), app.Batch(write_batch("A", "b2.json"))
+    b2.unload()
+
+    saver = threading.Thread(target=b1.set_annotation, args=(0, {"label": "4", "user": "A"}))
+    saver.start()
+    while not writer.has_pending(b1):
+        time.sleep(0.01)
+    b2.data # b1 is the least recently used batch now, over max_count
+    b1.data
+    saver.join() # acknowledged
+    writer.flush()
+
+    assert b1.pair(0)["annotation"]["label"] == "4"
+    with open(b1.batchfile) as f:
+        assert json.load(f)[0]["annotation"]["label"] == "4"
@@ -0,0 +1,56 @@
+import json
+import argparse
+import pytest
+import batchdb
+from paraanno import app
+from paraanno.sqlitestore import SqliteStore
+
+
+@pytest.fixture
+def store(write_batch, tmp_path, monkeypatch):
+    """A database imported from one batch of A by batchdb.py, served by the app as with PARAANN_STORAGE=sqlite"""
+    path = write_batch("A", "b1.json")
+    with open(path) as f:
+        data = json.load(f)
+    data[2]["annotation"] = None # older batch files have these
+    with open(path, "w") as f:
+        json.dump(data, f)
+    store = SqliteStore(str(tmp_path / "batches.sqlite"), str(tmp_path))
+    batchdb.import_batches(argparse.Namespace(data_dir=str(tmp_path), replace=False), store)
+    monkeypatch.setattr(app, "STORAGE", "sqlite")
+    monkeypatch.setattr(app, "all_batches", store)
+    monkeypatch.setattr(app, "journal_writer", None)
+    monkeypatch.setattr(app, "resident", None)
+    return store, data
+
+
+def test_round_trip(store, tmp_path):
+    store, data = store
+    c = app.app.test_client()
+    r = c.patch("/saveann/A/b1.json/0", json={"version": 0, "fields": {"label": "4", "flagged": "false"}})
+    assert r.status_code == 200 and r.get_json()["version"] == 1
+    data[0]["annotation"] = {"label": "4", "flagged": "false", "updated": r.get_json()["updated"], "version": 1}
+    r = c.patch("/saveann/A/b1.json/2", json={"version": 0, "fields": {"label": "x"}})
+    assert r.status_code == 200 and r.get_json()["version"] == 1
+    data[2]["annotation"] = {"label": "x", "updated": r.get_json()["updated"], "version": 1}
+    batch = store["A"]["b1.json"]
+    assert (batch.stats["completed"], batch.stats["skipped"], batch.stats["left"]) == (1, 1, 4)
+
+    out = tmp_path / "export"
+    batchdb.export_batches(argparse.Namespace(data_dir=str(out)), store)
+    assert (out / "batches-A" / "b1.json").read_text(encoding="utf-8") == batchdb.batch_json(data)
+
+def test_stale_patch_is_409(store):
+    store, _ = store
+    c = app.app.test_client()
+    assert c.patch("/saveann/A/b1.json/1", json={"version": 0, "fields": {"label": "4"}}).status_code == 200
+    r = c.patch("/saveann/A/b1.json/1", json={"version": 0, "fields": {"label": "3"}})
+    assert r.status_code == 409
+    assert r.get_json()["version"] == 1 and r.get_json()["annotation"]["label"] == "4"
+    assert store["A"]["b1.json"].pair(1)["annotation"]["label"] == "4"
+
+def test_null_annotation_is_left(store):
+    store, _ = store
+    batch = store["A"]["b1.json"]
+    assert batch.stats["left"] == 6
+    assert app.app.test_client().get("/ann/A/b1.json/2").status_code == 200